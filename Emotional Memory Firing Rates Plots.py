@@ -3,7 +3,8 @@
 The user can choose the sessions of interest (sessions are represented by local directories with the files associated with each session), 
 two brain states among the following:'sws', 'wake','Rem', and 'drowsy', and finally a brain structure among: 'Hpc' and 'BLA
 
-When the file is ran, the plots comparing BLA neural activity during wake, REM, and NREM sleep should be obtained.'''
+When the file is ran, the plots comparing BLA neural activity during wake, REM, and NREM sleep should be obtained.
+The firing rates are computed once for all sessions and then reused by every plot.'''
 
 import firingratefunctions as fr
 import pickle
@@ -11,10 +12,14 @@ import pickle
 with open('\sessions.pkl', 'rb') as f:
     session_paths = pickle.load(f)
 
-fr.plot_scatter(session_paths, ['wake','sws'], 'BLA')
+# To read the sessions from a local copy (prefetched while the previous session is processed), set a cache before computing:
+# import bk.load; bk.load.session_cache = bk.load.SessionCache('D:/cache')
+firing_rates = fr.compute_firing_rates(session_paths)
 
-fr.plot_scatter(session_paths, ['wake','Rem'], 'BLA')
+fr.plot_scatter(firing_rates, ['wake','sws'], 'BLA')
 
-fr.plot_both_histograms(session_paths, ['wake','sws'], 'BLA',bin_size=50, upper_axis_bound=100, lower_axis_bound=0.1)
+fr.plot_scatter(firing_rates, ['wake','Rem'], 'BLA')
 
-fr.plot_both_histograms(session_paths, ['wake','Rem'], 'BLA',bin_size=50, upper_axis_bound=100, lower_axis_bound=0.1)
+fr.plot_both_histograms(firing_rates, ['wake','sws'], 'BLA',bin_size=50, upper_axis_bound=100, lower_axis_bound=0.1)
+
+fr.plot_both_histograms(firing_rates, ['wake','Rem'], 'BLA',bin_size=50, upper_axis_bound=100, lower_axis_bound=0.1)
@@ -0,0 +1,75 @@
+''' Checks the output of bk.compute.binSpikes on a synthetic session, separately from the timings of run_benchmarks.py.
+Prints one line per check and exits with status 1 if one of them failed.
+
+Example:
+python benchmarks/check_binning.py --neurons 50 --duration 600
+'''
+
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bk.load
+import bk.compute
+import bk.intervals
+from synthetic_session import make_session, write_session_index
+
+
+def check_interval_binning(neurons, intervals, bin_size):
+    '''
+    Checks that binSpikes(..., intervals=...) keeps every complete bin: for intervals that are a whole number of bins long,
+    the summed counts must equal the number of spikes in [start, end) of the intervals.
+    Returns the list of failures (empty if the check passed).
+    '''
+    _, binned = bk.compute.binSpikes(neurons, bin_size, intervals=intervals)
+    times = np.sort(bk.compute.concatenate_spikes(neurons)[0]/1_000_000)
+    intervals = intervals.as_units('s')
+    expected = np.sum(np.searchsorted(times, intervals['end'].values, 'left')-np.searchsorted(times, intervals['start'].values, 'left'))
+    n_bins = np.sum(np.floor((intervals['end'].values-intervals['start'].values)/bin_size+1e-9))
+    failures = []
+    if binned.shape[1] != n_bins:
+        failures.append(f'binSpikes returned {binned.shape[1]} bins instead of {n_bins:.0f}')
+    if binned.sum() != expected:
+        failures.append(f'binSpikes counted {binned.sum()} spikes inside the intervals instead of {expected}')
+    return failures
+
+
+def run(directory, n_neurons, duration, seed):
+    '''Generates a session in directory and runs every check, returns {check name: list of failures}'''
+    name = 'Rat01-20200101'
+    path = make_session(directory, name, n_neurons=n_neurons, duration=duration, seed=seed)
+    index_file = os.path.join(directory, 'session_indexing.csv')
+    write_session_index(index_file, [path], [1], [1])
+    bk.load.session_index_file = index_file
+    bk.load.current_session(path)
+
+    neurons, metadata = bk.load.loadSpikeData(path)
+    states = bk.load.states(path)
+    # Epochs of sws rounded to whole seconds, so that they hold a whole number of 0.5 s bins
+    sws = states['sws'].as_units('s')
+    sws = bk.intervals.to_nts(bk.intervals.from_seconds(np.ceil(sws['start'].values), np.floor(sws['end'].values)))
+    return {'interval_binning': check_interval_binning(neurons, sws, 0.5)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the output of binSpikes on a synthetic session')
+    parser.add_argument('--neurons', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=600., help='duration of the session in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    cwd = os.getcwd() #bk.load.current_session changes the working directory
+    with tempfile.TemporaryDirectory() as directory:
+        checks = run(directory, args.neurons, args.duration, args.seed)
+        os.chdir(cwd)
+
+    for check, failures in checks.items():
+        print(f'{check:<25} ' + ('OK' if not failures else 'FAILED'))
+        for failure in failures:
+            print('    ' + failure)
+    sys.exit(1 if any(checks.values()) else 0)
@@ -0,0 +1,104 @@
+''' Times the loaders and compute functions on a synthetic session and writes a JSON report (wall time and peak memory of each step),
+so that the performance of bk.load, bk.compute and the firing rate pipeline can be tracked from one commit to the next.
+
+Example:
+python benchmarks/run_benchmarks.py --neurons 200 --duration 3600 --output bench_report.json
+
+Peak memory is measured with tracemalloc, which tracks the numpy and pandas allocations.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bk.load
+import bk.compute
+import firingratefunctions as fr
+from synthetic_session import make_session, write_session_index
+
+
+def measure(results, name, func, *args, **kwargs):
+    '''Runs func(*args, **kwargs), stores its wall time and peak memory in results[name] and returns its output'''
+    tracemalloc.start()
+    t = time.perf_counter()
+    output = func(*args, **kwargs)
+    wall_time = time.perf_counter()-t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results[name] = {'wall_time_s': wall_time, 'peak_memory_mb': peak/2**20}
+    print(f'{name:<25} {wall_time:10.3f} s {peak/2**20:10.1f} MB')
+    return output
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except Exception:
+        return None
+
+
+def run(directory, n_neurons, n_shanks, duration, n_channels, ccg_neurons, seed):
+    '''Generates a session in directory and times every step, returns the dict of results'''
+    name = 'Rat01-20200101'
+    path = make_session(directory, name, n_neurons=n_neurons, n_shanks=n_shanks, duration=duration, n_channels=n_channels, seed=seed)
+    index_file = os.path.join(directory, 'session_indexing.csv')
+    write_session_index(index_file, [path], [1], [1])
+    bk.load.session_index_file = index_file
+    bk.load.current_session(path)
+
+    results = {}
+    measure(results, 'loadSpikeData_cold', bk.load.loadSpikeData, path)
+    neurons, metadata = measure(results, 'loadSpikeData', bk.load.loadSpikeData, path)
+    states = measure(results, 'states', bk.load.states, path)
+    measure(results, 'lfp_in_intervals', bk.load.lfp_in_intervals, n_channels, 0, states['sws'], session_path=path)
+    measure(results, 'binSpikes', bk.compute.binSpikes, neurons, 0.025)
+    stimulus = np.sort(np.random.default_rng(seed).uniform(1, duration-1, 1000))
+    measure(results, 'psth', bk.compute.psth, neurons, stimulus, 0.01, [-1, 1])
+    measure(results, 'crosscorrelogram', bk.compute.crosscorrelogram, neurons[:ccg_neurons], 0.001, [-0.05, 0.05])
+    measure(results, 'firing_rates', fr.session_firing_rates, path, True)
+    measure(results, 'firing_rates_cached', fr.session_firing_rates, path)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark bk.load, bk.compute and firingratefunctions on a synthetic session')
+    parser.add_argument('--directory', default=None, help='where the synthetic session is written (default: a temporary folder)')
+    parser.add_argument('--neurons', type=int, default=100)
+    parser.add_argument('--shanks', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=600., help='duration of the session in seconds')
+    parser.add_argument('--channels', type=int, default=32)
+    parser.add_argument('--ccg-neurons', type=int, default=20, help='number of neurons used for the crosscorrelogram')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_report.json')
+    args = parser.parse_args()
+
+    parameters = {'neurons': args.neurons, 'shanks': args.shanks, 'duration': args.duration, 'channels': args.channels,
+                  'ccg_neurons': args.ccg_neurons, 'seed': args.seed}
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd() #bk.load.current_session changes the working directory
+    if args.directory is None:
+        with tempfile.TemporaryDirectory() as directory:
+            results = run(directory, args.neurons, args.shanks, args.duration, args.channels, args.ccg_neurons, args.seed)
+            os.chdir(cwd)
+    else:
+        results = run(args.directory, args.neurons, args.shanks, args.duration, args.channels, args.ccg_neurons, args.seed)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'commit': git_commit(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'parameters': parameters,
+              'results': results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report saved in ' + output)
@@ -0,0 +1,156 @@
+''' Generates synthetic sessions on local disk, with the same files as the sessions of the GG dataset, so that bk.load, bk.compute
+and the firing rate functions can be measured without access to the Z: share.
+
+Files written in <directory>/<name>/:
+<name>.xml, <name>.clu.N and <name>.res.N (one pair per shank), <name>-metadata.npy, States.mat, runintervals.mat, <name>.lfp and digitalin.dat
+
+Digital inputs: channel 0 camera frames, channel 1 experiment, channel 2 shocks, channel 3 tones.
+'''
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import scipy.io
+
+STATES_CYCLE = ['wake', 'drowsy', 'sws', 'Rem', 'sws']
+
+
+def write_xml(filename, n_channels, fs=20000, lfp_frequency=1250):
+    '''Writes a minimal neuroscope .xml file, readable by bk.load.xml'''
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0"?>\n<parameters>\n')
+        f.write(' <acquisitionSystem>\n')
+        f.write(f'  <nBits>16</nBits>\n  <nChannels>{n_channels}</nChannels>\n  <samplingRate>{fs}</samplingRate>\n')
+        f.write(' </acquisitionSystem>\n')
+        f.write(f' <fieldPotentials>\n  <lfpSamplingRate>{lfp_frequency}</lfpSamplingRate>\n </fieldPotentials>\n')
+        f.write('</parameters>\n')
+
+
+def write_spikes(directory, name, n_neurons, n_shanks, duration, mean_rate, rng, fs=20000):
+    '''
+    Writes one .clu/.res pair per shank with Poisson spike trains (log-normal firing rates) plus noise spikes in cluster 1.
+    Returns the shank and cluster id of every neuron, in the order bk.load.loadSpikeData returns them.
+    '''
+    shank_of_neuron = np.sort(np.arange(n_neurons) % n_shanks) + 1
+    neurons = []
+    for shank in range(1, n_shanks+1):
+        n_clusters = np.sum(shank_of_neuron == shank)
+        rates = mean_rate*rng.lognormal(0, 1, n_clusters)/np.exp(0.5)
+        counts = rng.poisson(rates*duration)
+        clu = np.repeat(np.arange(2, n_clusters+2), counts)
+        noise = rng.poisson(mean_rate*duration)
+        clu = np.concatenate([clu, np.ones(noise, dtype=int)])
+        res = rng.integers(0, int(duration*fs), len(clu))
+        order = np.argsort(res, kind='stable')
+        np.savetxt(os.path.join(directory, f'{name}.clu.{shank}'), np.concatenate([[n_clusters+2], clu[order]]), fmt='%d')
+        np.savetxt(os.path.join(directory, f'{name}.res.{shank}'), res[order], fmt='%d')
+        neurons.extend((shank, idx) for idx in range(2, n_clusters+2))
+    return neurons
+
+
+def write_metadata(filename, neurons, rat, day, rng):
+    '''Writes -metadata.npy (pickled object array, as in the dataset) with a random region per shank and a random type per neuron'''
+    regions = {shank: rng.choice(['BLA', 'Hpc']) for shank, _ in neurons}
+    types = rng.choice(['Pyr', 'Int', 'Unk'], len(neurons), p=[0.7, 0.2, 0.1])
+    metadata = np.array([[rat, day, shank, idx, regions[shank], t] for (shank, idx), t in zip(neurons, types)], dtype=object)
+    np.save(filename, metadata, allow_pickle=True)
+
+
+def write_states(filename, duration, rng, min_epoch=30, max_epoch=300):
+    '''Writes States.mat with consecutive, non overlapping epochs cycling through wake, drowsy, sws, Rem'''
+    epochs = {state: [] for state in STATES_CYCLE}
+    t = 0
+    i = 0
+    while t < duration:
+        length = min(rng.uniform(min_epoch, max_epoch), duration-t)
+        epochs[STATES_CYCLE[i % len(STATES_CYCLE)]].append([t, t+length])
+        t += length
+        i += 1
+    scipy.io.savemat(filename, {state: np.array(e, dtype=float).reshape(-1, 2) for state, e in epochs.items()})
+
+
+def write_runintervals(filename, duration):
+    '''Writes runintervals.mat with 3 runs, pre and post sleep being the periods in between (see bk.load.sleep)'''
+    third = duration/3
+    runs = np.array([[0, 0.05*third], [third, third+0.05*third], [2*third, 2*third+0.05*third]])
+    scipy.io.savemat(filename, {'runintervals': runs})
+
+
+def write_lfp(filename, duration, n_channels, rng, frequency=1250, chunk_duration=60):
+    '''Writes an int16 .lfp file (random signal), chunk by chunk'''
+    n_samples = int(duration*frequency)
+    with open(filename, 'wb') as f:
+        for start in range(0, n_samples, int(chunk_duration*frequency)):
+            n = min(int(chunk_duration*frequency), n_samples-start)
+            rng.integers(-2000, 2000, (n, n_channels), dtype=np.int16).tofile(f)
+
+
+def write_digitalin(filename, duration, rng, fs=20000, camera_rate=30, chunk_duration=60):
+    '''Writes a uint16 digitalin.dat file: camera frames (ch 0), experiment (ch 1), shocks (ch 2) and tones (ch 3), chunk by chunk'''
+    n_samples = int(duration*fs)
+    exp = (0.4*n_samples, 0.6*n_samples)
+    shocks = np.sort(rng.uniform(*exp, 10)).astype(np.int64)
+    tones = np.sort(rng.uniform(*exp, 10)).astype(np.int64)
+    frame_period = fs/camera_rate
+    with open(filename, 'wb') as f:
+        for start in range(0, n_samples, int(chunk_duration*fs)):
+            samples = np.arange(start, min(start+int(chunk_duration*fs), n_samples))
+            word = ((samples % frame_period) < frame_period/2).astype(np.uint16)
+            word |= ((samples >= exp[0]) & (samples < exp[1])).astype(np.uint16) << 1
+            shock_index = np.searchsorted(shocks, samples, side='right')-1
+            word |= ((shock_index >= 0) & (samples-shocks[shock_index] < 0.5*fs)).astype(np.uint16) << 2
+            tone_index = np.searchsorted(tones, samples, side='right')-1
+            word |= ((tone_index >= 0) & (samples-tones[tone_index] < 20*fs)).astype(np.uint16) << 3
+            word.tofile(f)
+
+
+def make_session(directory, name='Rat01-20200101', rat=1, day=1, n_neurons=100, n_shanks=4, duration=600., n_channels=32,
+                 mean_rate=5., lfp=True, digitalin=True, seed=0):
+    '''
+    Generates a synthetic session in directory/name and returns its path.
+
+    Keyword arguments:
+    directory -- string, folder in which the session folder is created
+    name -- string, name of the session (default='Rat01-20200101')
+    rat, day -- integers, written in the metadata (default=1)
+    n_neurons -- integer, number of neurons (default=100)
+    n_shanks -- integer, number of shanks the neurons are spread on (default=4)
+    duration -- float, duration of the recording in seconds (default=600)
+    n_channels -- integer, number of channels of the .lfp file (default=32)
+    mean_rate -- float, mean firing rate of the neurons in Hz (default=5)
+    lfp, digitalin -- booleans, write the .lfp and digitalin.dat files (default=True)
+    seed -- integer, seed of the random generator (default=0)
+    '''
+    rng = np.random.default_rng(seed)
+    path = os.path.join(directory, name)
+    os.makedirs(path, exist_ok=True)
+    write_xml(os.path.join(path, name+'.xml'), n_channels)
+    neurons = write_spikes(path, name, n_neurons, n_shanks, duration, mean_rate, rng)
+    write_metadata(os.path.join(path, name+'-metadata.npy'), neurons, rat, day, rng)
+    write_states(os.path.join(path, 'States.mat'), duration, rng)
+    write_runintervals(os.path.join(path, 'runintervals.mat'), duration)
+    if lfp:
+        write_lfp(os.path.join(path, name+'.lfp'), duration, n_channels, rng)
+    if digitalin:
+        write_digitalin(os.path.join(path, 'digitalin.dat'), duration, rng)
+    return path
+
+
+def write_session_index(filename, paths, rats, days):
+    '''Writes a session_indexing.csv for the generated sessions (see bk.load.registry)'''
+    pd.DataFrame({'Rat': rats, 'Day': days, 'Path': paths}).to_csv(filename, sep=';', index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic session')
+    parser.add_argument('directory')
+    parser.add_argument('--name', default='Rat01-20200101')
+    parser.add_argument('--neurons', type=int, default=100)
+    parser.add_argument('--shanks', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=600.)
+    parser.add_argument('--channels', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(make_session(args.directory, args.name, n_neurons=args.neurons, n_shanks=args.shanks,
+                       duration=args.duration, n_channels=args.channels, seed=args.seed))
@@ -1,47 +1,43 @@
 import numpy as np
 import neuroseries as nts
-from tqdm import tqdm
 import os
-import scipy.stats
+import scipy.ndimage
+import scipy.sparse
+import bk.load
+import bk.intervals
 
 def freezing_intervals(speed,threshold, mode='single_speed',clean = False, t_merge = 0.5,t_drop = 1,save = False):
     
     """
         BK 8/11/20
         Input 
-            speed: speed vector as output by bk.compute.speed (not yet implemented. But it's an nts.frame)
+            speed: speed as output by bk.compute.speed (nts.TsdFrame, one column per body part) or nts.Tsd
             treshold: arbritary units
+            mode : 'single_speed' (speed of one body part), 'multiple_speed' (mean speed of the body parts)
+                   or 'pca' (speeds weighted by the loadings of their first principal component, so that the threshold stays in speed units)
     """
-    
+    t = np.asarray(speed.index.values,dtype = np.int64)
+    v = np.asarray(speed.values,dtype = np.float64)
+    if v.ndim == 1: v = v[:,None]
     
     if mode.lower() =='single_speed':
-        fs =  1/scipy.stats.mode(np.diff(speed.as_units('s').index)).mode[0]
-        freezing = speed.values<threshold
-        
-        if freezing[0] == 1: freezing[0] = 0
-        if freezing[-1] == 1: freezing = np.append(freezing,0)
-
-        dfreeze = np.diff(freezing.astype(np.int8))
-        start = np.where(dfreeze == 1)[0]/fs + speed.as_units('s').index[0]
-        end = np.where(dfreeze == -1)[0]/fs + speed.as_units('s').index[0]
+        combined = v[:,0]
     elif mode.lower() == 'multiple_speed':
-        fs =  1/scipy.stats.mode(np.diff(speed.as_units('s').index)).mode[0]
-        freezing = np.array((np.sum(speed.as_units('s'),axis = 1))/speed.shape[1] < threshold)
-        
-        if freezing[0] == 1: freezing[0] = 0
-        if freezing[-1] == 1: freezing = np.append(freezing,0)
-
-        dfreeze = np.diff(freezing.astype(np.int8))
-        start = np.where(dfreeze == 1)[0]/fs + speed.as_units('s').index[0]
-        end = np.where(dfreeze == -1)[0]/fs + speed.as_units('s').index[0]
+        combined = v.mean(axis = 1)
     elif mode.lower() == 'pca':
-        print('not implanted')
+        combined = v @ pca_weights(v)
     else:
         print('Mode not recognized')
         return False
-    freezing_intervals = nts.IntervalSet(start,end,time_units = 's')
+    
+    #Edges on the sample before the change, a freezing at the end of the recording ends on the last sample
+    start,end = TTL_edge_index(combined<threshold)
+    keep = end>start
+    freezing_intervals = np.column_stack([t[start[keep]],t[end[keep]]])
     if clean:
-        freezing_intervals = freezing_intervals.merge_close_intervals(t_merge,time_units = 's').drop_short_intervals(t_drop,time_units = 's')
+        freezing_intervals = bk.intervals.merge_close(freezing_intervals,t_merge*1_000_000)
+        freezing_intervals = bk.intervals.drop_short(freezing_intervals,t_drop*1_000_000)
+    freezing_intervals = bk.intervals.to_nts(freezing_intervals)
         
     
     if save:
@@ -49,44 +45,96 @@ def freezing_intervals(speed,threshold, mode='single_speed',clean = False, t_mer
     
     return freezing_intervals
 
-def freezing_video(video_path,output_file,tf,freezing_intervals):
+def pca_weights(v):
+    '''
+        Weights of the columns of v (samples * body parts) along its first principal component,
+        as absolute values summing to 1, so that v @ weights is a weighted mean speed.
+        Only the rows where every column is finite are used, equal weights if there are less than 2 of them.
+    '''
+    if v.shape[1] == 1: return np.ones(1)
+    v = v[np.isfinite(v).all(axis = 1)]
+    if len(v) < 2: return np.full(v.shape[1],1/v.shape[1])
+    centered = v - v.mean(axis = 0)
+    eigenvalues,eigenvectors = np.linalg.eigh(centered.T @ centered)
+    loadings = np.abs(eigenvectors[:,np.argmax(eigenvalues)])
+    return loadings/loadings.sum()
+
+def freezing_mask(tf,freezing_intervals):
+    #Boolean per frame, True when the frame (times tf in s) falls in a freezing interval
+    tf = (np.asarray(tf)*1_000_000).astype(np.int64)
+    return bk.intervals.in_interval(tf,bk.intervals.from_nts(freezing_intervals)) >= 0
+
+def freezing_video(video_path,output_file,tf,freezing_intervals,show = False,start_frame = 0,stop_frame = None,fourcc = 'MJPG',buffer_size = 64):
     
     """
         video_path : path to the video to be displaying
         outputfile : path to the video to written
         tf : vector of time containing timing of each frame
         freezing intervals : Intervals when the animal is freezing (as nts.Interval_Set)
+        show : display the frames while writing (needs a display), press q to stop. Headless by default
+        start_frame, stop_frame : only frames start_frame to stop_frame (excluded) are written, stop_frame = None goes to the end of the video
+        fourcc : codec of the output video
+        buffer_size : number of frames queued in between the reading, annotating and writing threads
+        
+        Frames are decoded in one thread and encoded in another, the freezing state of every frame is computed once beforehand.
     """
     import cv2
+    import queue
+    import threading
 
     if os.path.exists(output_file):
         print(output_file,'already exist, please delete manually')
         return
     
-    tf = nts.Ts(tf,time_units='s')
-    freezing_frames = np.where(freezing_intervals.in_interval(tf)>=0)[0]
-    fs =  1/scipy.stats.mode(np.diff(tf.as_units('s').index)).mode[0]
+    tf = np.asarray(tf,dtype = np.float64)
+    freezing = freezing_mask(tf,freezing_intervals)
+    fs = 1/np.median(np.diff(tf))
     cap  = cv2.VideoCapture(video_path)
-    frame_width = int(cap.get(3))
-    frame_height = int(cap.get(4))
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if stop_frame is None: stop_frame = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or np.inf
+    if start_frame: cap.set(cv2.CAP_PROP_POS_FRAMES,start_frame)
+    
+    out = cv2.VideoWriter(output_file,cv2.VideoWriter_fourcc(*fourcc), fs, (frame_width,frame_height))
+    read_frames = queue.Queue(buffer_size)
+    annotated_frames = queue.Queue(buffer_size)
+    stop = threading.Event()
+    
+    def reader():
+        nf = start_frame
+        while nf < stop_frame and not stop.is_set():
+            ret,frame = cap.read()
+            if not ret: break
+            read_frames.put((nf,frame))
+            nf += 1
+        read_frames.put(None)
+    
+    def writer():
+        while True:
+            frame = annotated_frames.get()
+            if frame is None: break
+            out.write(frame)
     
-    nf = 0
-    out = cv2.VideoWriter(output_file,cv2.VideoWriter_fourcc('M','J','P','G'), fs, (frame_width,frame_height))
+    threads = [threading.Thread(target = reader,daemon = True),threading.Thread(target = writer,daemon = True)]
+    for thread in threads: thread.start()
     while True:
-        
-        ret,frame = cap.read()
-        if ret == True:
-            if nf in freezing_frames: frame = cv2.circle(frame,(25,25),10,(0,0,255),20)
-
+        item = read_frames.get()
+        if item is None: break
+        nf,frame = item
+        if nf < len(freezing) and freezing[nf]: frame = cv2.circle(frame,(25,25),10,(0,0,255),20)
+        annotated_frames.put(frame)
+        if show:
             cv2.imshow(video_path,frame)
-            out.write(frame)
-            if cv2.waitKey(1) & 0xFF == ord('q'): 
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                stop.set()
+                #Unblock the reader if it waits on a full queue
+                while read_frames.get() is not None: pass
                 break
-            nf +=1
-        else:
-            break
+    annotated_frames.put(None)
+    for thread in threads: thread.join()
     cap.release()
     out.release()
+    if show: cv2.destroyWindow(video_path)
     
     return True
 
@@ -95,54 +143,68 @@ def tone_intervals(digital_tone, Fs = 20000, t_merge = 1, t_drop = 1):
         Input : digitalin channel of tone
         Return, nts.IntervalSet for tones, (and Fq of tones)
     """
-    edges = TTL_edges(digital_tone,Fs)
-    
-    tone_intervals = nts.IntervalSet(edges.start,edges.end).merge_close_intervals(t_merge,time_units = 's').drop_short_intervals(t_drop,time_units = 's')
+    t_start,t_end = TTL_edge_index(digital_tone)
+    tone_intervals = clean_events(t_start/Fs,t_end/Fs,t_merge,t_drop)
     
-    return tone_intervals
+    return bk.intervals.to_nts(tone_intervals)
+
+def clean_events(t_start,t_end,t_merge = 1,t_drop = 1):
+    #(n,2) int64 array (us) of the events (s) separated by more than t_merge and longer than t_drop (s)
+    events = bk.intervals.from_seconds(t_start,t_end)
+    events = bk.intervals.merge_close(events,t_merge*1_000_000)
+    return bk.intervals.drop_short(events,t_drop*1_000_000)
     
 
+def TTL_changes(TTL,previous = 0,offset = 0):
+    '''
+        Rising and falling edges of one chunk of a TTL (bool, uint8 or int array of 0/1).
+        previous : last sample of the preceding chunk, offset : index of TTL[0] in the whole signal
+        Edges are indexed on the last sample before the change (an edge in between two chunks is at offset-1).
+    '''
+    TTL = np.asarray(TTL)
+    TTL = TTL.view(np.uint8) if TTL.dtype == bool else (TTL != 0).view(np.uint8)
+    change = np.flatnonzero(TTL[1:] != TTL[:-1])
+    high_after = TTL[change+1] == 1
+    rising = change[high_after] + offset
+    falling = change[~high_after] + offset
+    if len(TTL) and TTL[0] != previous:
+        if TTL[0]: rising = np.insert(rising,0,offset-1)
+        else: falling = np.insert(falling,0,offset-1)
+    return rising,falling
+
+def TTL_edge_index(TTL,chunk_size = 10_000_000):
+    '''
+        Index of the start and end of every pulse of a TTL, computed chunk by chunk so that TTL can be a memory map.
+        A TTL high at the beginning starts at the first sample and a TTL high at the end ends at the last sample,
+        this convention is shared by TTL_edges, TTL_to_intervals and TTL_to_times.
+    '''
+    starts,ends = [np.array([],dtype = np.int64)],[np.array([],dtype = np.int64)]
+    previous = 0
+    for offset in range(0,len(TTL),chunk_size):
+        chunk = TTL[offset:offset+chunk_size]
+        rising,falling = TTL_changes(chunk,previous,offset)
+        starts.append(rising)
+        ends.append(falling)
+        previous = int(chunk[-1] != 0)
+    
+    starts = np.maximum(np.concatenate(starts),0)
+    ends = np.concatenate(ends)
+    if previous: ends = np.append(ends,len(TTL)-1)
+    return starts,ends
+
 def TTL_edges(TTL,Fs = 20000):
-    if isinstance(TTL[0],(np.bool_,bool)):
-        TTL = list(map(int,TTL))
-    
-    if TTL[0] == 1: TTL[0] = 0
-    if TTL[-1] == 1: TTL.append(0)
-        
-    diff_TTL = np.diff(TTL)
-    
-    t_start = np.where(diff_TTL == 1)[0]
-    t_end = np.where(diff_TTL == -1)[0]
-    
+    t_start,t_end = TTL_edge_index(TTL)
     edges = nts.IntervalSet(t_start/Fs,t_end/Fs,time_units = 's')
     return edges
     
 def TTL_to_intervals(TTL,Fs = 20000):
-    if isinstance(TTL[0],(np.bool_,bool)):
-        TTL = list(map(int,TTL))
-    
-    
-    diff_TTL = np.diff(TTL)
-    
-    t_start = np.where(diff_TTL == 1)[0]
-    t_end = np.where(diff_TTL == -1)[0]
-    t_TTL = np.array([np.mean(interval) for interval in zip(t_start,t_end)])
-    
-    
+    t_start,t_end = TTL_edge_index(TTL)
     return (t_start/Fs,t_end/Fs)
 
 
 def TTL_to_times(TTL,Fs = 20000):
-    
-    if isinstance(TTL[0],(np.bool_,bool)):
-        TTL = list(map(int,TTL))
-    
-    diff_TTL = np.diff(TTL)
-    
-    t_start = np.where(diff_TTL == 1)[0]
-    t_end = np.where(diff_TTL == -1)[0]
-    t_TTL = np.array([np.mean(interval) for interval in zip(t_start,t_end)])
-    
+    t_start,t_end = TTL_edge_index(TTL)
+    t_TTL = (t_start + t_end)/2
     return t_TTL/Fs
 
 def old_speed(pos,value_gaussian_filter,pixel = 0.43):
@@ -156,53 +218,222 @@ def old_speed(pos,value_gaussian_filter,pixel = 0.43):
     
     return v
 	
+def body_parts(pos,columns_to_drop = None):
+    #Body parts of a DLC position frame (first level of the columns), sorted as np.unique does
+    parts = np.unique([c[0] for c in pos.columns])
+    if columns_to_drop is not None:
+        parts = parts[~np.isin(parts,np.atleast_1d(columns_to_drop))]
+    return parts
+
+def positions(pos,parts):
+    '''
+        Positions of the body parts as one array of shape (frames, body parts, 2) for x and y,
+        with the times of the frames in s
+    '''
+    t = pos.as_units('s').index.values
+    columns = [(p,c) for p in parts for c in ('x','y')]
+    xy = pos[columns].values.astype(np.float64).reshape(len(t),len(parts),2)
+    return t,xy
+
+def interpolate_nan(t,values):
+    '''
+        Replace the non finite values of every column of values (samples along axis 0) by linear interpolation in time t,
+        the ones before the first / after the last finite sample take its value. Columns without any finite sample are left as they are.
+    '''
+    values = np.array(values,dtype = np.float64)
+    flat = values.reshape(len(values),-1)
+    for column in flat.T:
+        finite = np.isfinite(column)
+        if finite.any() and not finite.all():
+            column[~finite] = np.interp(t[~finite],t[finite],column[finite])
+    return values
+
 def speed(pos,value_gaussian_filter, columns_to_drop=None):
+    '''
+        Speed of every body part of a DLC position frame, in pixels/s, smoothed with a gaussian filter (in frames).
+        All body parts are computed at once on the (frames, body parts, 2) array of positions.
+        Non finite positions are interpolated first, so that one bad frame does not spread over the smoothing window.
+        Return nts.TsdFrame, one column per body part (without columns_to_drop)
+    '''
+    parts = body_parts(pos,columns_to_drop)
+    t,xy = positions(pos,parts)
+    xy = interpolate_nan(t,xy)
     
-    body = []
-    for i in pos:
-        body.append(i[0])
-    body = np.unique(body)
-    
-    all_speed = np.empty((len(pos)-1,5))
-    i = 0
-    for b in body:
-        x_speed = np.diff(pos.as_units('s')[b]['x'])/np.diff(pos.as_units('s').index)
-        y_speed = np.diff(pos.as_units('s')[b]['y'])/np.diff(pos.as_units('s').index)
-    
-        v = np.sqrt(x_speed**2 + y_speed**2)
-        all_speed[:,i] = v
-        i +=1
+    all_speed = np.hypot(*np.moveaxis(np.diff(xy,axis = 0),2,0))/np.diff(t)[:,None]
     all_speed = scipy.ndimage.gaussian_filter1d(all_speed,value_gaussian_filter,axis=0)
-    all_speed = nts.TsdFrame(t = pos.index.values[:-1],d = all_speed,columns = body)
-    if columns_to_drop != None: all_speed = all_speed.drop(columns=columns_to_drop)
+    all_speed = nts.TsdFrame(t = pos.index.values[:-1],d = all_speed,columns = parts)
     
     return all_speed
 
-def binSpikes(neurons,binSize = 0.025,start = 0,stop = 0,nbins = None,centered = True):
+def concatenate_spikes(neurons):
+    '''
+        Concatenate the spike times of all neurons in one array sorted by time.
+        Returns the spike times (int64, us) and the index of the neuron each spike belongs to.
+        neurons can be an array of nts.Tsd or a bk.load.SpikeStore
+    '''
+    if hasattr(neurons,'offsets'):
+        ids = np.repeat(np.arange(len(neurons)),neurons.counts())
+        order = np.argsort(neurons.times,kind = 'stable')
+        return np.asarray(neurons.times)[order],ids[order]
+    
+    times = [np.asarray(neuron.index.values,dtype = np.int64) for neuron in neurons]
+    ids = np.repeat(np.arange(len(times)),[len(t) for t in times])
+    if not times: return np.array([],dtype = np.int64),ids
+
+    times = np.concatenate(times)
+    order = np.argsort(times,kind = 'stable')
+    return times[order],ids[order]
+
+def binSpikes(neurons,binSize = 0.025,start = 0,stop = 0,nbins = None,centered = True,intervals = None,sparse = False,dtype = None):
     '''
         Bin neuronal spikes with difine binSize.
         If no start/stop provided will run trought all the data
         
         If centered will return the center of each bin. Otherwise will return edges
+        
+        nbins : number of bins (or array of edges) in between start and stop, overwrites binSize
+        intervals : nts.IntervalSet, only the complete bins inside the intervals are returned (ex : bk.load.states()['sws']),
+                    bins start at the beginning of each interval.
+        sparse : return a scipy.sparse.csr_matrix instead of a dense array
+        dtype : dtype of the counts, default is the smallest unsigned integer holding the largest count.
+                A ValueError is raised if the counts do not fit in the given dtype.
+        
+        All spikes are binned in a single vectorized pass over the concatenated spike times (see binSpikes_chunks to stream long sessions).
     '''
+    times,ids = concatenate_spikes(neurons)
+    times = times/1_000_000
+    if stop == 0 and len(times):
+        stop = times[-1]
+    
+    if intervals is not None:
+        lefts,rights = np.concatenate([bin_edges(s,e,binSize) for s,e in interval_segments(intervals)] + [np.empty((2,0))],axis = 1)
+    elif nbins is not None:
+        edges = np.linspace(start,stop,nbins+1) if np.isscalar(nbins) else np.asarray(nbins,dtype = float)
+        lefts,rights = edges[:-1],edges[1:]
+    else:
+        lefts,rights = session_bin_edges(start,stop,binSize)
     
-    if stop == 0:
-        stop = np.max([neuron.as_units('s').index[-1] for neuron in neurons if any(neuron.index)])
+    binned = count_spikes(times,ids,len(neurons),lefts,rights,sparse,dtype)
     
-    bins = np.arange(start,stop,binSize)
-    if nbins: bins = nbins
+    if intervals is not None:
+        b = lefts + binSize/2 if centered else lefts
+    elif centered:
+        b = (lefts + rights)/2
+    else:
+        b = np.append(lefts,rights[-1:])
+    return b,binned
 
-    binned = np.empty((len(neurons),len(bins)-1),dtype = 'int8')
-    
+def binSpikes_chunks(neurons,binSize = 0.025,chunk_size = 100_000,start = 0,stop = 0,intervals = None,centered = True,sparse = False,dtype = None):
+    '''
+        Generator version of binSpikes for sessions that do not fit in memory (ex : 1 ms bins over 20 h).
+        Yields (t,binned) for consecutive chunks of at most chunk_size bins, in [start,stop) or inside intervals.
+        Bins do not cross the boundaries of the intervals. Arguments are the same as binSpikes.
+    '''
+    times,ids = concatenate_spikes(neurons)
+    times = times/1_000_000
+    if stop == 0 and len(times):
+        stop = times[-1]
+    segments = [(start,stop)] if intervals is None else interval_segments(intervals)
+    
+    for s,e in segments:
+        n_bins = len(session_bin_edges(s,e,binSize)[0]) if intervals is None else n_complete_bins(s,e,binSize)
+        for first in range(0,n_bins,chunk_size):
+            lefts = s + np.arange(first,min(first + chunk_size,n_bins))*binSize
+            rights = lefts + binSize
+            binned = count_spikes(times,ids,len(neurons),lefts,rights,sparse,dtype)
+            yield (lefts + binSize/2 if centered else lefts),binned
 
-    # IF NUMBER OF BINS IS USED THIS WILL OVERWRITE binSize    
-    for i,neuron in enumerate(neurons):
-        binned[i],b = np.histogram(neuron.as_units('s').index,bins = bins,range = [start,stop])
+def interval_segments(intervals):
+    #(start,end) in s of each interval of an nts.IntervalSet
+    intervals = intervals.as_units('s')
+    return list(zip(intervals.start.values,intervals.end.values))
 
-    if centered:
-        b = np.convolve(b,[.5,.5],'same')[1::]
-    return b,binned
+def n_complete_bins(start,stop,binSize):
+    #Number of bins of binSize that fit entirely in [start,stop] (with a tolerance for floating point)
+    return max(int(np.floor((stop - start)/binSize + 1e-9)),0)
+
+def bin_edges(start,stop,binSize):
+    #Left and right edges of every complete bin start + k * binSize in [start,stop]
+    edges = start + np.arange(n_complete_bins(start,stop,binSize) + 1)*binSize
+    return np.array([edges[:-1],edges[1:]])
+
+def session_bin_edges(start,stop,binSize):
+    #Left and right edges of the bins with edges start + k * binSize < stop (same edges as np.arange(start,stop,binSize), as the original binSpikes)
+    edges = start + np.arange(max(int(np.ceil((stop - start)/binSize)),0))*binSize
+    return np.array([edges[:-1],edges[1:]])
+
+def count_spikes(times,ids,n,lefts,rights,sparse = False,dtype = None):
+    '''
+        Count the spikes (times sorted, in s, with the neuron id of each spike) in the bins [lefts,rights).
+        Bins must be sorted and not overlap. Return a neurons * bins array (or csr_matrix).
+    '''
+    n_bins = len(lefts)
+    if n_bins:
+        in_range = slice(np.searchsorted(times,lefts[0],'left'),np.searchsorted(times,rights[-1],'left'))
+        t = times[in_range]
+        k = np.searchsorted(lefts,t,'right') - 1
+        valid = t < rights[k]
+        codes,counts = np.unique(ids[in_range][valid]*n_bins + k[valid],return_counts = True)
+    else:
+        codes,counts = np.array([],dtype = np.int64),np.array([],dtype = np.int64)
+    
+    max_count = int(counts.max()) if len(counts) else 0
+    if dtype is None:
+        dtype = np.min_scalar_type(max_count)
+    elif max_count > np.iinfo(dtype).max:
+        raise ValueError('Up to ' + str(max_count) + ' spikes per bin, does not fit in ' + str(np.dtype(dtype)))
+    
+    if sparse:
+        return scipy.sparse.csr_matrix((counts.astype(dtype),(codes//n_bins,codes%n_bins)),shape = (n,n_bins))
+    binned = np.zeros((n,n_bins),dtype = dtype)
+    binned.flat[codes] = counts
+    return binned
+
+
+def state_timeline(states,min_length = 1):
+    '''
+        Merge a dict of nts.IntervalSet (ex : bk.load.states()) in one timeline sorted by start.
+        Intervals shorter than min_length (us) are dropped. The states are expected not to overlap.
+        
+        Return start, end (us), label (index of the state in names) of every epoch and names
+    '''
+    names = [state for state in states if len(states[state])]
+    start = np.concatenate([states[state]['start'].values for state in names] + [np.array([],dtype = np.int64)]).astype(np.int64)
+    end = np.concatenate([states[state]['end'].values for state in names] + [np.array([],dtype = np.int64)]).astype(np.int64)
+    label = np.repeat(np.arange(len(names)),[len(states[state]) for state in names])
+    
+    keep = (end - start) > min_length
+    start,end,label = start[keep],end[keep],label[keep]
+    order = np.argsort(start,kind = 'stable')
+    return start[order],end[order],label[order],names
 
+def transition_sequences(states,sequence,epsilon = 1):
+    '''
+        states : dict of nts.Interval_Set
+        sequence : states visited one after the other, ex : ('sws','Rem') or ('sws','Rem','sws')
+        epsilon : tolerance time delay between state (s)
+        
+        Find every occurence of the sequence of consecutive epochs, the input is not modified.
+        Return
+            intervals : nts.IntervalSet from the start of the first epoch to the end of the last one
+            times : transition times (us), occurences * (len(sequence)-1), middle of the gap between two epochs
+    '''
+    start,end,label,names = state_timeline(states)
+    m = len(sequence)
+    n_candidates = len(start) - m + 1
+    if any(state not in names for state in sequence) or n_candidates <= 0:
+        return nts.IntervalSet([],[]),np.empty((0,m-1),dtype = np.int64)
+    
+    consecutive = (start[1:] - end[:-1]) <= epsilon * 1_000_000
+    match = np.ones(n_candidates,dtype = bool)
+    for k,state in enumerate(sequence):
+        match &= label[k:k+n_candidates] == names.index(state)
+        if k < m - 1: match &= consecutive[k:k+n_candidates]
+    
+    first = np.flatnonzero(match)
+    times = np.array([(end[first+k] + start[first+k+1])//2 for k in range(m-1)],dtype = np.int64).reshape(m-1,len(first)).T
+    intervals = nts.IntervalSet(start[first],end[first+m-1],force_no_fix = True)
+    return intervals,times
 
 def transitions_times(states,epsilon = 1):
     '''
@@ -213,49 +444,27 @@ def transitions_times(states,epsilon = 1):
         
         epsilon : tolerance time delay between state
         
-        This function does NOT WORK for triple transitions (ex : sws/rem/sws) ... 
+        All the epochs are merged in one timeline and every pair of consecutive epochs is labelled in one vectorized pass,
+        states is not modified. For sequences of more than two states (ex : sws/rem/sws) see transition_sequences.
         
     '''
-    
     import itertools
     
-    empty_state = []
-    for state in states:
-        if len(states[state]) == 0:
-            empty_state.append(state)
-            continue
-        states[state] = states[state].drop_short_intervals(1)
-    
+    start,end,label,names = state_timeline(states)
+    consecutive = np.flatnonzero(((start[1:] - end[:-1]) <= epsilon * 1_000_000) & (label[1:] != label[:-1]))
+    pair = label[consecutive]*len(names) + label[consecutive+1]
     
-    for i in empty_state: del states[i]
-        
     transitions_intervals = {}
     transitions_timing = {}
-    
-    for items in itertools.permutations(states.keys(),2):
-#         states[items[0]] = states[items[0]].drop_short_intervals(1)
-#         states[items[1]] = states[items[1]].drop_short_intervals(1)
-        
-        print('Looking at transition from',items[0],' to ',items[1])
-        end = nts.Ts(np.array(states[items[0]].end + (epsilon * 1_000_000)+1))
-        in_next_epoch = states[items[1]].in_interval(end)
-        
-        transitions_intervals.update({items:[]})
-        transitions_timing.update({items:[]})
-
-        for n,t in enumerate(in_next_epoch):
-            if np.isnan(t): continue            
-            start = states[items[0]].iloc[n].start
-            trans = int(np.mean([states[items[0]].iloc[n].end,states[items[1]].iloc[int(t)].start]))
-            end  = states[items[1]].iloc[int(t)].end
-            transitions_intervals[items].append([start,end])
-            transitions_timing[items].append(trans)
-        
-        if  not transitions_timing[items] == []:      
-            transitions_intervals[items] = np.array(transitions_intervals[items])
-            transitions_intervals[items] = nts.IntervalSet(transitions_intervals[items][:,0],transitions_intervals[items][:,1],force_no_fix = True)
-            
-            transitions_timing[items] = nts.Ts(t = np.array(transitions_timing[items]))
+    for items in itertools.permutations(range(len(names)),2):
+        key = (names[items[0]],names[items[1]])
+        first = consecutive[pair == items[0]*len(names) + items[1]]
+        if len(first) == 0:
+            transitions_intervals[key] = []
+            transitions_timing[key] = []
+            continue
+        transitions_intervals[key] = nts.IntervalSet(start[first],end[first+1],force_no_fix = True)
+        transitions_timing[key] = nts.Ts(t = (end[first] + start[first+1])//2)
     return transitions_intervals,transitions_timing
 
 def nts_smooth(y,m,std):
@@ -267,67 +476,184 @@ def nts_smooth(y,m,std):
     y = nts.Tsd(y.index.values,conv)
     return y
 
-def intervals_exp(force_reload = False, save = False):
-    files = os.listdir()
-    if ('intervals.npy' in files) and (force_reload == False):
-        with open('intervals.npy', 'rb') as f:
-            exp = np.load(f)
-            shock = np.load(f)
-            tone = np.load(f)
-            exp = nts.IntervalSet(exp[:,0],exp[:,1],time_units='us')
-            shock = nts.IntervalSet(shock[:,0],shock[:,1],time_units='us')
-            tone = nts.IntervalSet(tone[:,0],tone[:,1],time_units='us')
-            return (exp, shock, tone)
+#digitalin.dat channels decoded by event_intervals, more can be passed through the channels argument
+event_channels = {'exp':1,'shock':2,'tone':3}
+#Bump when the content of intervals.npz changes so that old caches are decoded again
+intervals_cache_version = 2
+
+def file_fingerprint(filename):
+    #(size, mtime in ns) of the source of a cache
+    stat = os.stat(filename)
+    return np.array([stat.st_size,stat.st_mtime_ns],dtype = np.int64)
+
+def read_intervals_cache(cache_file,fingerprint,channels,parameters):
+    '''
+        Return {name : array (n,2) of int64 us} from intervals.npz, or None if the cache is missing, from another version,
+        older than digitalin.dat, computed with other parameters (Fs, t_merge, t_drop) or does not hold every requested channel.
+    '''
+    if not os.path.exists(cache_file): return None
+    with np.load(cache_file) as cache:
+        if 'version' not in cache.files or cache['version'] != intervals_cache_version: return None
+        if not np.array_equal(cache['fingerprint'],fingerprint): return None
+        if not np.array_equal(cache['parameters'],parameters): return None
+        cached = dict(zip(cache['names'],cache['channels']))
+        if any(cached.get(name) != channel for name,channel in channels.items()): return None
+        return {name:cache['intervals_'+name] for name in channels}
+
+def event_intervals(session_path = None,channels = None,force_reload = False,save = False,Fs = 20000,t_merge = 1,t_drop = 1):
+    '''
+        Intervals of the events recorded in digitalin.dat (exp, shock, tone by default).
+        All channels are decoded in a single streaming pass (bk.load.digitalin_edges). With save they are cached in intervals.npz,
+        with the size and mtime of digitalin.dat and the parameters, so that a plain read does not write into the session folder.
+        An existing cache is used as long as digitalin.dat and the parameters did not change.
         
-    exp = bk.compute.tone_intervals(bk.load.digitalin('digitalin.dat')[1,:])
-    shock = bk.compute.tone_intervals(bk.load.digitalin('digitalin.dat')[2,:])
-    tone = bk.compute.tone_intervals(bk.load.digitalin('digitalin.dat')[3,:])
-    
-    if save:
-        with open('intervals.npy', 'wb') as f:
-            np.save(f, exp)
-            np.save(f, shock)
-            np.save(f, tone)
-    
-    return (exp, shock, tone)
+        session_path : folder of the session (default : current directory)
+        channels : dict {name : channel}, added to event_channels
+        t_merge, t_drop : in s, see tone_intervals
+        Return dict {name : nts.IntervalSet}
+    '''
+    if session_path is None: session_path = os.getcwd()
+    channels = {**event_channels,**(channels or {})}
+    source = os.path.join(session_path,'digitalin.dat')
+    cache_file = os.path.join(session_path,'intervals.npz')
+    fingerprint = file_fingerprint(source)
+    parameters = np.array([Fs,t_merge,t_drop],dtype = np.float64)
+    
+    intervals = None if force_reload else read_intervals_cache(cache_file,fingerprint,channels,parameters)
+    if intervals is None:
+        edges = bk.load.digitalin_edges(source,sorted(set(channels.values())),Fs)
+        intervals = {}
+        for name,channel in channels.items():
+            intervals[name] = clean_events(*edges[channel],t_merge,t_drop)
+        if save:
+            arrays = {'intervals_'+name:i for name,i in intervals.items()}
+            np.savez(cache_file,version = intervals_cache_version,fingerprint = fingerprint,parameters = parameters,
+                     names = np.array(list(channels),dtype = str),channels = np.array(list(channels.values()),dtype = np.int64),**arrays)
+    
+    return {name:bk.intervals.to_nts(i) for name,i in intervals.items()}
+
+def intervals_exp(force_reload = False, save = False, session_path = None):
+    #(exp, shock, tone) IntervalSets, read from the intervals.npz cache (see event_intervals)
+    intervals = event_intervals(session_path,force_reload = force_reload,save = save)
+    return (intervals['exp'], intervals['shock'], intervals['tone'])
 
-def psth(neurons,stimulus,binSize,win,average = True):
+def psth(neurons,stimulus,binSize,win,average = True,t_start = 0,t_stop = None):
+    '''
+        Peri-stimulus time histogram, without binning the whole session.
+        The spikes around each event are found with searchsorted on the sorted spike times and
+        their offsets to the event are histogrammed in one np.bincount.
+        
+        neurons : array of nts.Tsd (or bk.load.SpikeStore)
+        stimulus : times of the events (s)
+        binSize, win : in s, win = [start,end] around the events
+        average : if True return the mean over events (bins * neurons), otherwise counts for every event (events * neurons * bins)
+        t_start, t_stop : limits of the recording (s). Bins of an event that fall outside are NaN (trial resolved)
+                          and are left out of the mean, instead of wrapping around the session.
+                          t_stop = None uses the last spike time, pass the end of the session when it is known (np.inf for no limit).
+        
+        Return t (left edge of the bins relative to the event, s), psth
+    '''
     if isinstance(neurons,nts.time_series.Tsd): 
-        neurons = np.array(neurons,'object')
+        #np.array([neurons],'object') would unpack the Tsd into a 2D array
+        neuron = neurons
+        neurons = np.empty(1,dtype = 'object')
+        neurons[0] = neuron
+    stimulus = np.asarray(stimulus,dtype = float).ravel()
     winLen = int((win[1] - win[0])/binSize)
     window = np.arange(winLen,dtype = int)-int(winLen/2)
-    stim_bin = (stimulus/binSize).astype('int')
-    t,binned = binSpikes(neurons,binSize,start = 0, stop = stimulus[-1]+win[-1])
-    psth = np.empty((stimulus.size,len(neurons),winLen))
-    
-    for i,t in tqdm(enumerate(stim_bin)):
-        psth[i] = binned[:,t+window]
-    if average:    
-        psth = np.mean(psth,0).T
+    n = len(neurons)
+    
+    times,ids = concatenate_spikes(neurons)
+    times = times/1_000_000
+    if t_stop is None: t_stop = times[-1] if len(times) else np.inf
+    first_edge = window[0]*binSize
+    event,j = expand_ranges(np.searchsorted(times,stimulus + first_edge,'left'),np.searchsorted(times,stimulus + first_edge + winLen*binSize,'left'))
+    lag_bin = np.floor((times[j] - stimulus[event] - first_edge)/binSize).astype(np.int64)
+    
+    bin_start = stimulus[:,None] + window*binSize
+    outside = (bin_start < t_start) | (bin_start + binSize > t_stop)
+    valid = (lag_bin >= 0) & (lag_bin < winLen)
+    valid[valid] = ~outside[event[valid],lag_bin[valid]]
+    event,neuron,lag_bin = event[valid],ids[j[valid]],lag_bin[valid]
+    
+    if average:
+        counts = np.bincount(neuron*winLen + lag_bin,minlength = n*winLen).reshape(n,winLen)
+        with np.errstate(invalid = 'ignore',divide = 'ignore'):
+            psth = (counts / np.sum(~outside,0)).T
+    else:
+        psth = np.bincount((event*n + neuron)*winLen + lag_bin,minlength = len(stimulus)*n*winLen).reshape(len(stimulus),n,winLen).astype(float)
+        psth[np.broadcast_to(outside[:,None,:],psth.shape)] = np.nan
     t = window*binSize
     return t,psth
 
 
-def crosscorrelogram(neurons,binSize,win):
+def expand_ranges(first,last):
+    '''
+        For a list of ranges [first[i],last[i]), return the index of the range of each element and the elements themselves,
+        without a python loop.
+    '''
+    counts = np.asarray(last) - np.asarray(first)
+    owner = np.repeat(np.arange(len(counts)),counts)
+    elements = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - np.asarray(first),counts)
+    return owner,elements
+
+def crosscorrelogram(neurons,binSize,win,pairs = None,n_jobs = 1,chunk_size = 100_000):
+    '''
+        Crosscorrelograms computed directly on the sorted spike times of the session.
+        For every spike of a reference neuron, the spikes of all neurons falling in the window are found with searchsorted
+        and their lags are counted with np.bincount. No binning of the whole session is needed.
+        
+        neurons : array of nts.Tsd (or bk.load.SpikeStore)
+        binSize, win : in s, win = [start,end] of the lags
+        pairs : list of (reference,target), default None computes all pairs
+        n_jobs : number of threads the reference neurons are split on
+        chunk_size : number of reference spikes processed at once (bounds memory)
+        
+        Return
+            t : lags (s)
+            crosscorr : int32 counts, lags * neurons * neurons with crosscorr[:,i,j] the spikes of j around the spikes of i
+                        (lags * pairs if pairs is given). The auto-correlograms contain the reference spike at lag 0.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    
     if isinstance(neurons,nts.time_series.Tsd): 
-        neurons = np.array(neurons,'object')
+        #np.array([neurons],'object') would unpack the Tsd into a 2D array
+        neuron = neurons
+        neurons = np.empty(1,dtype = 'object')
+        neurons[0] = neuron
     winLen = int((win[1] - win[0])/binSize)
     window = np.arange(winLen,dtype = int)-int(winLen/2)
-    crosscorr = np.empty((winLen,len(neurons),len(neurons)),dtype = 'float16')
-    last_spike = np.max([n.as_units('s').index[-1] for n in neurons])
-    t,binned = binSpikes(neurons,binSize,start = 0, stop = last_spike+win[-1])
-
-    for i,n in tqdm(enumerate(neurons),total = len(neurons)):
-        stimulus = n.as_units('s').index
-        stim_bin = (stimulus/binSize).astype('int')
-        psth = np.empty((stimulus.size,len(neurons),winLen),dtype = 'float16')
-
-        for j,t in enumerate(stim_bin):
-            psth[j] = binned[:,t+window]
-#             psth[j][:,window == 0] -= 1
-
-        psth = np.sum(psth,0).T
-        crosscorr[:,i] = psth
-        t = window*binSize
-        
-    return t,crosscorr
\ No newline at end of file
+    binSize_us = binSize * 1_000_000
+    first_edge = (window[0] - 0.5) * binSize_us
+    last_edge = (window[-1] + 0.5) * binSize_us
+    
+    times,ids = concatenate_spikes(neurons)
+    n = len(neurons)
+    #Spikes of each neuron, contiguous, to get the reference spikes without scanning the whole session
+    by_neuron = times[np.argsort(ids,kind = 'stable')]
+    offsets = np.zeros(n+1,dtype = np.int64)
+    offsets[1:] = np.cumsum(np.bincount(ids,minlength = n))
+    
+    def correlate(i):
+        counts = np.zeros(n*winLen,dtype = np.int64)
+        reference = by_neuron[offsets[i]:offsets[i+1]]
+        for c in range(0,len(reference),chunk_size):
+            r = reference[c:c+chunk_size]
+            owner,j = expand_ranges(np.searchsorted(times,r + first_edge,'left'),np.searchsorted(times,r + last_edge,'left'))
+            lag_bin = np.floor((times[j] - r[owner] - first_edge) / binSize_us).astype(np.int64)
+            valid = (lag_bin >= 0) & (lag_bin < winLen)
+            counts += np.bincount(ids[j[valid]]*winLen + lag_bin[valid],minlength = n*winLen)
+        return counts.reshape(n,winLen).T
+    
+    references = range(n) if pairs is None else sorted({p[0] for p in pairs})
+    with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        correlograms = dict(zip(references,pool.map(correlate,references)))
+    
+    if pairs is None:
+        crosscorr = np.empty((winLen,n,n),dtype = 'int32')
+        for i in references: crosscorr[:,i] = correlograms[i]
+    else:
+        crosscorr = np.empty((winLen,len(pairs)),dtype = 'int32')
+        for k,(i,j) in enumerate(pairs): crosscorr[:,k] = correlograms[i][:,j]
+    t = window*binSize
+    return t,crosscorr
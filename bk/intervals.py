@@ -0,0 +1,110 @@
+'''
+    Interval algebra on raw numpy arrays.
+
+    A set of intervals is an int64 array of shape (n,2) holding start and end in us, sorted by start and not overlapping
+    (as returned by normalize). Intervals are (start,end], as nts.IntervalSet.in_interval and nts.Tsd.restrict.
+    Nothing here goes through pandas, convert with from_nts / to_nts at the boundaries.
+'''
+import numpy as np
+import neuroseries as nts
+
+def from_nts(intervals):
+    #(n,2) int64 array (us) of an nts.IntervalSet
+    if len(intervals) == 0: return np.empty((0,2),dtype = np.int64)
+    return np.column_stack([intervals['start'].values,intervals['end'].values]).astype(np.int64)
+
+def to_nts(intervals):
+    #nts.IntervalSet of a (n,2) array (us)
+    return nts.IntervalSet(intervals[:,0],intervals[:,1],time_units = 'us')
+
+def from_seconds(start,end):
+    #(n,2) int64 array (us) of start and end in s, sorted and merged
+    start = np.round(np.asarray(start,dtype = np.float64)*1_000_000)
+    end = np.round(np.asarray(end,dtype = np.float64)*1_000_000)
+    return normalize(np.column_stack([start,end]).astype(np.int64))
+
+def normalize(intervals):
+    '''
+        Sort the intervals by start, drop the empty ones and merge the ones that overlap or touch.
+    '''
+    intervals = np.asarray(intervals,dtype = np.int64).reshape(-1,2)
+    intervals = intervals[intervals[:,1] > intervals[:,0]]
+    if len(intervals) < 2: return intervals
+    intervals = intervals[np.argsort(intervals[:,0],kind = 'stable')]
+
+    reach = np.maximum.accumulate(intervals[:,1])
+    first = np.flatnonzero(np.concatenate([[True],intervals[1:,0] > reach[:-1]]))
+    return np.column_stack([intervals[first,0],np.maximum.reduceat(intervals[:,1],first)])
+
+def tot_length(intervals):
+    #Total length (us)
+    return int(np.sum(intervals[:,1] - intervals[:,0]))
+
+def union(*sets):
+    return normalize(np.concatenate([np.asarray(s,dtype = np.int64).reshape(-1,2) for s in sets]))
+
+def intersect(a,b):
+    '''
+        Intersection of two normalized sets of intervals.
+        Boundaries of both sets are swept in time order, the intersection is where both sets are open.
+    '''
+    a,b = np.asarray(a,dtype = np.int64).reshape(-1,2),np.asarray(b,dtype = np.int64).reshape(-1,2)
+    times = np.concatenate([a[:,0],b[:,0],a[:,1],b[:,1]])
+    delta = np.concatenate([np.ones(len(a)+len(b),dtype = np.int8),-np.ones(len(a)+len(b),dtype = np.int8)])
+    #Ends before starts at the same time, (start,end] intervals that only touch do not intersect
+    order = np.lexsort((delta,times))
+    times,depth = times[order],np.cumsum(delta[order])
+
+    i = np.flatnonzero(depth == 2)
+    intervals = np.column_stack([times[i],times[i+1]])
+    return intervals[intervals[:,1] > intervals[:,0]]
+
+def complement(intervals):
+    #Everything that is not in the normalized set of intervals
+    intervals = np.asarray(intervals,dtype = np.int64).reshape(-1,2)
+    bounds = np.iinfo(np.int64)
+    start = np.concatenate([[bounds.min],intervals[:,1]])
+    end = np.concatenate([intervals[:,0],[bounds.max]])
+    gaps = np.column_stack([start,end])
+    return gaps[gaps[:,1] > gaps[:,0]]
+
+def difference(a,b):
+    #Part of a that is not in b (both normalized)
+    return intersect(a,complement(b))
+
+def in_interval(t,intervals):
+    '''
+        Index of the interval each time t (us) falls in, -1 outside of the intervals.
+        Same result as nts.IntervalSet.in_interval (with -1 instead of NaN), t does not need to be sorted.
+    '''
+    t = np.asarray(t)
+    k = np.searchsorted(intervals[:,0],t,'left') - 1
+    inside = (k >= 0) & (t <= intervals[np.maximum(k,0),1]) if len(intervals) else np.zeros(t.shape,dtype = bool)
+    return np.where(inside,k,-1)
+
+def restrict_mask(t,intervals):
+    '''
+        Boolean mask of the sorted times t (us) that fall in the intervals.
+        Each interval flags its range of t with a +1/-1 cumulative sum, linear in len(t).
+    '''
+    first = np.searchsorted(t,intervals[:,0],'right')
+    last = np.searchsorted(t,intervals[:,1],'right')
+    flags = np.zeros(len(t)+1,dtype = np.int64)
+    np.add.at(flags,first,1)
+    np.add.at(flags,last,-1)
+    return np.cumsum(flags[:-1]) > 0
+
+def restrict(t,intervals):
+    #Sorted times t (us) that fall in the intervals
+    return t[restrict_mask(t,intervals)]
+
+def merge_close(intervals,threshold):
+    #Merge the intervals separated by at most threshold (us), as nts.IntervalSet.merge_close_intervals
+    if len(intervals) < 2: return intervals
+    first = np.flatnonzero(np.concatenate([[True],(intervals[1:,0] - intervals[:-1,1]) > threshold]))
+    last = np.concatenate([first[1:],[len(intervals)]]) - 1
+    return np.column_stack([intervals[first,0],intervals[last,1]])
+
+def drop_short(intervals,threshold):
+    #Keep the intervals longer than threshold (us), as nts.IntervalSet.drop_short_intervals
+    return intervals[(intervals[:,1] - intervals[:,0]) > threshold]
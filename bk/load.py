@@ -12,10 +12,78 @@ from IPython.display import clear_output
 import xml.etree.ElementTree as ET
 
 import os
+import re
+import traceback
+import threading
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import bk.compute
 
+class SessionRegistry:
+    """
+    In memory index of a session_indexing.csv file, read only once.
+    Sessions can be found in O(1) by their path (as written in the csv), by their absolute path or by their name (ex : Rat08-20130713).
+    
+    base : folder the paths of the csv are relative to (relative_session_indexing.csv of the linux layout), None if the paths are absolute
+    """
+    def __init__(self,table,base = None):
+        self.table = table
+        self.base = base
+        self.records = table.to_dict('records')
+        self.by_path = {}
+        self.by_name = {}
+        for i,record in enumerate(self.records):
+            self.by_path[record['Path']] = i
+            self.by_path[self.absolute_path(record['Path'])] = i
+            self.by_name[session_name(record['Path'])] = i
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __contains__(self,key):
+        return key in self.by_path or session_name(key) in self.by_name
+
+    @property
+    def paths(self):
+        #Absolute paths of all the sessions, in the order of the csv
+        return [self.absolute_path(record['Path']) for record in self.records]
+
+    def absolute_path(self,path):
+        if self.base is None: return path
+        return os.path.join(self.base,path)
+
+    def get(self,key):
+        #Return the row of the csv (as a dict) of a session from its path or name
+        if key in self.by_path: return self.records[self.by_path[key]]
+        name = session_name(key)
+        if name in self.by_name: return self.records[self.by_name[name]]
+        raise KeyError('Session ' + str(key) + ' is not in the session index')
+
+    def session(self,key):
+        #Return a Session object from the path or name of the session
+        record = self.get(key)
+        return Session(self.absolute_path(record['Path']),record['Rat'],record['Day'])
+
+registries = {}
+registries_lock = threading.Lock()
+session_index_file = 'Z:/All-Rats/Billel/session_indexing.csv' #Default index, can be changed to work on another copy of the data (ex : benchmarks)
+
+def registry(index_file = None,sep = ';',base = None):
+    #Return the SessionRegistry of an index file. The file is read from disk (or network share) only the first time.
+    if index_file is None: index_file = session_index_file
+    with registries_lock:
+        if index_file not in registries:
+            registries[index_file] = SessionRegistry(pd.read_csv(index_file,sep = sep),base)
+        return registries[index_file]
+
+def linux_registry(base_folder = '/home/billel/Data/GG-Dataset/'):
+    return registry(os.path.join(base_folder,'relative_session_indexing.csv'),sep = ',',base = base_folder)
+
 def sessions():
-    return pd.read_csv('Z:/All-Rats/Billel/session_indexing.csv',sep = ';')
+    return registry().table
 
 def current_session(path_local = 'Z:\Rat08\Rat08-20130713'):
     #Author : BK 08/20
@@ -24,29 +92,24 @@ def current_session(path_local = 'Z:\Rat08\Rat08-20130713'):
     #Variable are stored in global variables.
     
         #Create Global variable that allow for all function to know in wich session we are this usefull only for variable that are going to be recurentyly used. Do not overuse this functionnality as it can add inconstansies. 
-    global session, path, rat, day,n_channels
+        #The globals are now filled from a Session object (stored in current), prefer using Session directly when several sessions are needed at the same time.
+    global session, path, rat, day,n_channels,current
 
-    
-    session_index = pd.read_csv('Z:/All-Rats/Billel/session_indexing.csv',sep = ';')
+    current = Session(path_local)
    
-    path = path_local
+    path = current.path
     os.chdir(path)
 
+    session = current.session
+    rat = current.rat
+    day = current.day
 
-    session = path.split('\\')[2]
-    rat = session_index['Rat'][session_index['Path'] == path].values[0]
-    day = session_index['Day'][session_index['Path'] == path].values[0]
-
-    n_channels = xml(session)['nChannels']
+    n_channels = current.n_channels
     
     
     print('Rat : ' + str(int(rat)) + ' on day : ' + str(int(day)))
     print('Working with session ' + session + ' @ ' + path)
     
-    
-    
-   
-    
     return True
 
 def xml(session):
@@ -62,8 +125,14 @@ def xml(session):
                 pass
     return xmlInfo
 
-def sleep():
-    runs = scipy.io.loadmat('runintervals.mat')['runintervals']
+def session_folder(session_path = None):
+    #session_path if given, else the folder of the current session (current_session), else the working directory
+    if session_path is not None: return session_path
+    return globals().get('path',os.getcwd())
+
+def sleep(session_path = None):
+    session_path = session_folder(session_path)
+    runs = scipy.io.loadmat(os.path.join(session_path,'runintervals.mat'))['runintervals']
     pre_sleep = nts.IntervalSet(start = runs[0,1],end = runs[1,0],time_units = 's')
     post_sleep = nts.IntervalSet(start = runs[1,1],end = runs[2,0],time_units = 's')
     
@@ -76,20 +145,110 @@ def current_session_linux(base_folder = '/home/billel/Data/GG-Dataset/',local_pa
     #output : True if loading was done correctly
     #Variable are stored in global variables.
         #Create Global variable that allow for all function to know in wich session we are this usefull only for variable that are going to be recurentyly used. Do not overuse this functionnality as it can add inconstansies. 
-    global base,session, path, rat, day,n_channels
+    global base,session, path, rat, day,n_channels,current
     base = base_folder
-    os.chdir(base)
-    session_index = pd.read_csv('relative_session_indexing.csv')
-    session = local_path.split('/')[1]
-    rat = session_index['Rat'][session_index['Path'] == local_path].values[0]
-    day = session_index['Day'][session_index['Path'] == local_path].values[0]
-    path = os.path.join(base,local_path)
+    current = linux_registry(base).session(local_path)
+    session = current.session
+    rat = current.rat
+    day = current.day
+    path = current.path
+    n_channels = current.n_channels
     os.chdir(path)
     print('Rat : ' + str(int(rat)) + ' on day : ' + str(int(day)))
     print('Working with session ' + session + ' @ ' + path)
     return True
 
-def batch(func,verbose = False):
+class Session:
+    """
+    Context of one recording session : path, rat, day, n_channels and the data of the session.
+    Nothing is stored in global variables and the working directory is never changed,
+    so several sessions can be opened at the same time, also from different threads.
+    The data (xml, spikes, metadata, states, lfp) are loaded the first time they are accessed and then kept in memory.
+    
+    If rat and day are not given they are looked up in the session index (read only once, see registry()).
+    """
+    def __init__(self,path,rat = None,day = None):
+        self.path = path
+        self.session = session_name(path)
+        if rat is None or day is None:
+            record = registry().get(path)
+            rat = record['Rat']
+            day = record['Day']
+        self.rat = rat
+        self.day = day
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return 'Session(' + self.session + ', rat ' + str(int(self.rat)) + ', day ' + str(int(self.day)) + ')'
+
+    def file(self,extension):
+        #Absolute path of a file of the session, ex : file('.xml')
+        return os.path.join(self.path,self.session + extension)
+
+    def _memoize(self,key,loader):
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = loader()
+            return self._cache[key]
+
+    @property
+    def xml(self):
+        return self._memoize('xml',lambda : xml(os.path.join(self.path,self.session)))
+
+    @property
+    def n_channels(self):
+        return self.xml['nChannels']
+
+    @property
+    def spikes(self):
+        #Tuple (neurons, metadata) as returned by loadSpikeData
+        return self._memoize('spikes',lambda : loadSpikeData(self.path,session = self.session))
+
+    @property
+    def neurons(self):
+        return self.spikes[0]
+
+    @property
+    def metadata(self):
+        return self.spikes[1]
+
+    @property
+    def states(self):
+        return self._memoize('states',lambda : states(self.path))
+
+    @property
+    def lfp_file(self):
+        #LFPReader (read only memory map) of the .lfp file, shared with bk.load.lfp and closed by release_lfp_readers
+        return lfp_reader(self.file('.lfp'),self.n_channels)
+
+    def lfp(self,start,stop,channel = 64,step = 1):
+        #Same output as bk.load.lfp, read from the memory map of the session
+        timestep,data = self.lfp_file.read(start,stop,channel,step)
+        if type(channel) is list:
+            return nts.TsdFrame(timestep,data,time_units = 's')
+        return nts.Tsd(timestep,data,time_units = 's')
+
+    def lfp_in_intervals(self,channel,intervals,step = 1):
+        t,data = self.lfp_file.read_intervals(intervals,channel,step)
+        if type(channel) is list:
+            return nts.TsdFrame(t,data,time_units = 's')
+        return nts.Tsd(t,data,time_units = 's')
+
+    def sleep(self):
+        return self._memoize('sleep',lambda : sleep(self.path))
+
+    def pos(self):
+        return self._memoize('pos',lambda : pos(session_path = self.path))
+
+    def freezing_intervals(self):
+        return freezing_intervals(self.path)
+
+def session_name(path):
+    #Return the name of the session (ex : Rat08-20130713) from its path, with windows or linux separators
+    return re.split(r'[\\/]',path.rstrip('\\/'))[-1]
+
+def batch(func,verbose = False,n_workers = 1,cache = None):
     
     #Author : BK
     #Date : 08/20
@@ -98,36 +257,193 @@ def batch(func,verbose = False):
     #Output : Output of the function
     
     #This function batch over all rat / all session and return output of the functions.
+    #If n_workers > 1 the sessions are dispatched to a pool of processes with batch_parallel.
+    #With a SessionCache (cache, or bk.load.session_cache), func gets the local copy of each session and the next one is prefetched.
     
     
     t = time.time()
-    session_index = pd.read_csv('Z:/All-Rats/Billel/session_indexing.csv',sep = ';')
-    pbar = ProgressBar()
+    paths = registry().paths
     
-    error = []
-    output_dict = {}
-    for path in tqdm(session_index['Path']):
-#         os.chdir(path)
-        session = path.split('\\')[2]
-        print('Loading Data from ' + session)
-        
-        try:
-            output = func(path)
-            output_dict.update({session:output})
-            if not verbose: clear_output()
-        except:
-            error.append(session)
-            print('Error in session ' + session)
-            if not verbose: clear_output()
+    if n_workers != 1:
+        output_dict,errors = batch_parallel(func,paths,n_workers,verbose)
+        error = list(errors)
+    else:
+        error = []
+        output_dict = {}
+        if cache is None: cache = session_cache
+        for path in tqdm(paths if cache is None else cache.prefetched(paths),total = len(paths)):
+            session = session_name(path)
+            print('Loading Data from ' + session)
+            
+            #Same error handling as the workers of batch_parallel (SystemExit of loadSpikeData included)
+            success,output = run_session(func,path)
+            if success:
+                output_dict.update({session:output})
+                if not verbose: clear_output()
+            else:
+                error.append(session)
+                print('Error in session ' + session)
+                if verbose: print(output)
+                else: clear_output()
     print('Batch finished in ' + str(time.time() - t))
     
     if error:
         print('Some session were not processed correctly')
         print(error)
-        print(len(error)/len(session_index['Path'])*100,'%')
+        print(len(error)/len(paths)*100,'%')
         
     return output_dict
 
+def run_session(func,path):
+    #Run func on one session inside a worker process.
+    #Exceptions are returned as text so that one failing session does not stop the batch.
+    #SystemExit too, loadSpikeData calls sys.exit when the path does not exist.
+    #The LFP files of the session opened by func are closed at the end, so that they are not kept open for the rest of the batch.
+    try:
+        return True,func(path)
+    except (Exception,SystemExit):
+        return False,traceback.format_exc()
+    finally:
+        release_lfp_readers(path)
+
+def batch_parallel(func,paths,n_workers = None,verbose = False):
+    """
+    Run func(path) for every session path in a pool of processes.
+    Each worker has its own bk.load globals and working directory, so func can call current_session as in batch.
+    func has to be picklable (defined at the top level of a module, or a functools.partial of such function).
+    On Windows the calling script must be protected by if __name__ == '__main__'.
+    
+    Input 
+        func : function taking the path of a session
+        paths : list of session paths
+        n_workers : number of processes (default os.cpu_count())
+    Return
+        output_dict : {session : output}, in the same order as paths
+        errors : {session : traceback} for sessions that raised
+    """
+    paths = list(paths)
+    outputs = {}
+    errors = {}
+    with ProcessPoolExecutor(max_workers = n_workers) as pool:
+        futures = {pool.submit(run_session,func,path):path for path in paths}
+        for future in tqdm(as_completed(futures),total = len(futures)):
+            session = session_name(futures[future])
+            try:
+                success,output = future.result()
+            except Exception:
+                success,output = False,traceback.format_exc()
+            if success:
+                outputs[session] = output
+            else:
+                errors[session] = output
+                print('Error in session ' + session)
+                if verbose: print(output)
+    
+    output_dict = {}
+    for path in paths:
+        session = session_name(path)
+        if session in outputs: output_dict[session] = outputs[session]
+    return output_dict,errors
+
+
+#Files of a session mirrored by SessionCache, {} is replaced by the name of the session
+cached_files = ['{}.xml','States.mat','{}-neurons.npy','{}-metadata.npy','{}-spiketimes.npy','{}-spikeoffsets.npy','{}-spikemetadata.npy',
+                'runintervals.mat','posClean.mat','freezing_intervals.npy','intervals.npz','positions.npz','{}-firingrates.npz']
+
+class SessionCache:
+    """
+    Read-through cache of sessions stored on a network share (Z:, \\\\AGNODICE\\IcyBox ...), mirrored in a local folder (SSD).
+    fetch(path) copies the files of the session that are missing or changed (size / mtime) in folder/<session> and returns
+    the local path, which can be given to every loader (current_session, loadSpikeData, states ...).
+    The .lfp file is only mirrored with include_lfp, clu/res files only if the session has no saved spikes.
+    When the cache is bigger than max_bytes, the least recently used sessions are deleted.
+    
+    Example :
+        cache = bk.load.SessionCache('D:/cache')
+        for local_path in cache.prefetched(paths):
+            ... #the next session is copied in the background
+    """
+    def __init__(self,folder,max_bytes = 100*2**30,include_lfp = False):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.include_lfp = include_lfp
+        self.lock = threading.RLock()
+        self.pinned = set()
+        os.makedirs(folder,exist_ok = True)
+
+    def session_files(self,path):
+        #Names of the files of the session to mirror
+        name = session_name(path)
+        files = set(os.listdir(path))
+        wanted = [f.format(name) for f in cached_files]
+        if self.include_lfp: wanted.append(name + '.lfp')
+        if not all(name + suffix in files for suffix in spike_store_suffixes) and name + '-neurons.npy' not in files:
+            wanted += [f for f in files if ('.clu.' in f or '.res.' in f) and f[0] != '.']
+        return [f for f in wanted if f in files]
+
+    def fetch(self,path):
+        #Local copy of the session, only the files that changed since the last fetch are copied
+        name = session_name(path)
+        local = os.path.join(self.folder,name)
+        with self.lock:
+            self.pinned.add(name)
+        try:
+            os.makedirs(local,exist_ok = True)
+            for f in self.session_files(path):
+                source,target = os.path.join(path,f),os.path.join(local,f)
+                stat = os.stat(source)
+                if os.path.exists(target):
+                    local_stat = os.stat(target)
+                    if local_stat.st_size == stat.st_size and int(local_stat.st_mtime) == int(stat.st_mtime): continue
+                #Copy then rename, so that a copy interrupted half way is never read
+                shutil.copy2(source,target + '.part')
+                os.replace(target + '.part',target)
+            os.utime(local) #Last use of the session, for the LRU eviction
+            self.evict()
+        finally:
+            with self.lock:
+                self.pinned.discard(name)
+        return local
+
+    def size(self,name):
+        local = os.path.join(self.folder,name)
+        return sum(os.path.getsize(os.path.join(local,f)) for f in os.listdir(local))
+
+    def evict(self):
+        #Delete the least recently used sessions (not being fetched) until the cache fits in max_bytes
+        with self.lock:
+            sessions = [d for d in os.listdir(self.folder) if os.path.isdir(os.path.join(self.folder,d))]
+            sizes = {d:self.size(d) for d in sessions}
+            total = sum(sizes.values())
+            for d in sorted(sessions,key = lambda d: os.path.getmtime(os.path.join(self.folder,d))):
+                if total <= self.max_bytes: break
+                if d in self.pinned: continue
+                release_lfp_readers(os.path.join(self.folder,d))
+                shutil.rmtree(os.path.join(self.folder,d),ignore_errors = True)
+                total -= sizes[d]
+
+    def prefetched(self,paths):
+        #Yield the local path of each session while the next one is fetched by a background thread
+        from concurrent.futures import ThreadPoolExecutor
+        paths = list(paths)
+        if not paths: return
+        with ThreadPoolExecutor(max_workers = 1) as pool:
+            future = pool.submit(self.fetch,paths[0])
+            for i in range(len(paths)):
+                #A session that cannot be copied is read from its original location
+                try: local = future.result()
+                except OSError: local = paths[i]
+                name = session_name(local)
+                with self.lock:
+                    self.pinned.add(name)
+                if i + 1 < len(paths): future = pool.submit(self.fetch,paths[i+1])
+                try:
+                    yield local
+                finally:
+                    with self.lock:
+                        self.pinned.discard(name)
+
+session_cache = None #SessionCache used by batch when no cache is given, ex : bk.load.session_cache = bk.load.SessionCache('D:/cache')
     
 def get_raw_data_directory(raw_data_directory = "\\\AGNODICE\IcyBox"):
     return raw_data_directory
@@ -140,24 +456,25 @@ def get_session_path(session_name):
     return session_path
 
 
-def pos(save=False):
+def pos(save=False,session_path = None):
     #BK : 04/08/2020
     #Return a NeuroSeries DataFrame of position whith the time as index
     
 #     session_path = get_session_path(session_name)
     import csv
     
-    pos_clean = scipy.io.loadmat(path + "/posClean.mat")['posClean']
+    session_path = session_folder(session_path)
+    pos_clean = scipy.io.loadmat(os.path.join(session_path,"posClean.mat"))['posClean']
 #     if save == True :
 #         with open('position'+'.csv', 'w') as csvfile:
 #             filewriter=csv.writer(csvfile)
     return nts.TsdFrame(t = pos_clean[:,0],d = pos_clean[:,1:],columns = ['x','y'],time_units = 's')
 
-def states():
+def states(session_path = None):
     #BK : 17/09/2020
     #Return a dict with variable from States.
-#     if session_path == 0 : session_path = get_session_path(session_name)
-    states = scipy.io.loadmat(path + '/States.mat')
+    session_path = session_folder(session_path)
+    states = scipy.io.loadmat(os.path.join(session_path,'States.mat'))
     
     useless  = ['__header__','__version__','__globals__']
     for u in useless:
@@ -168,7 +485,7 @@ def states():
         
     return states_
 
-def loadSpikeData(path, index=None, fs = 20000):  
+def loadSpikeData(path, index=None, fs = 20000, session = None, as_store = False):  
     ### Adapted from Viejo github https://github.com/PeyracheLab/StarterPack/blob/master/python/wrappers.py
     ### Modified by BK 06/08/20
     ### Modification are explicit with comment
@@ -182,20 +499,28 @@ def loadSpikeData(path, index=None, fs = 20000):
     Thus, the next loading of spike times will be faster
     Notes :
         If the frequency is not givne, it's assumed 20kH
+    Spikes are saved in a SpikeStore (see save_spike_store), sessions that only have the old
+    -neurons.npy (pickled object array) are converted the first time they are loaded.
     Args:
         path : string
+        session : name of the session, by default taken from path
+        as_store : return the SpikeStore (memory mapped) instead of an array of nts.Tsd
 
     Returns:
-        dict, array    
+        array (or SpikeStore), DataFrame    
     """
     
-#     try session:
-#     except: print('Did you load a session first?')
-    
+    if session is None: session = session_name(path)
     
     if not os.path.exists(path):
         print("The path "+path+" doesn't exist; Exiting ...")
         sys.exit()
+    store = load_spike_store(path,session)
+    if store is not None:
+        print('Data already saved in SpikeStore format, loading them from here:')
+        print(session +'-spiketimes.npy')
+        if as_store: return store,store.metadata
+        return store.to_neurons(),store.metadata
     if os.path.exists(path + '//' + session +'-neurons.npy'):
         print('Data already saved in Numpy format, loading them from here:')
         print(session +'-neurons.npy')
@@ -203,6 +528,9 @@ def loadSpikeData(path, index=None, fs = 20000):
         print(session +'-metadata.npy')
         shanks = np.load(path+'//' + session +'-metadata.npy',allow_pickle=True)
         shanks = pd.DataFrame(shanks,columns = ['Rat','Day','Shank','Id','Region','Type'])
+        print('Converting to SpikeStore format')
+        store = convert_spike_store(path,session,neurons,shanks)
+        if as_store: return store,shanks
         return neurons,shanks
                       
     files = os.listdir(path)
@@ -225,146 +553,564 @@ def loadSpikeData(path, index=None, fs = 20000):
 #         sys.exit()
 #   Commented this because in GG dataset their .clu.12.54.21.63 files that mess up everything ...
     
-    count = 0
-    spikes = []
     basename = clu_files[0].split(".")[0]
     idx_clu_returned = []
-    for i, s in zip(range(len(clu_files)),clu1):
-        clu = np.genfromtxt(os.path.join(path,basename+'.clu.'+str(s)),dtype=np.int32)[1:]
-        print('Loading '+basename + '.clu.' + str(s))
-        if np.max(clu)>1:
-            res = np.genfromtxt(os.path.join(path,basename+'.res.'+str(s)))
-            tmp = np.unique(clu).astype(int)
-            idx_clu = tmp[tmp>1]
-            idx_clu_returned.extend(idx_clu) # Allow to return the idx of each neurons on it's shank. Very important for traceability
-            idx_col = np.arange(count, count+len(idx_clu))       
-            tmp = pd.DataFrame(index = np.unique(res)/fs,
-                                columns = pd.MultiIndex.from_product([[s],idx_col]),
-                                data = 0, 
-                                dtype = np.uint16)
-            
-            for j, k in zip(idx_clu, idx_col):
-                tmp.loc[res[clu==j]/fs,(s,k)] = np.uint16(k+1)
-            spikes.append(tmp)
-            count+=len(idx_clu)
-
     #Returning a list instead of dict in order to use list of bolean.
     toreturn =  []
     shank = []
-    for s in spikes:
-        shank.append(s.columns.get_level_values(0).values)
-        sh = np.unique(shank[-1])[0]
-        for i,j in s:
-            toreturn.append(nts.Tsd(t=s[(i,j)].replace(0,np.nan).dropna().index.values, time_units = 's'))
+    for i, s in zip(range(len(clu_files)),clu1):
+        print('Loading '+basename + '.clu.' + str(s))
+        idx_clu,spike_samples = read_clu_res(os.path.join(path,basename+'.clu.'+str(s)),os.path.join(path,basename+'.res.'+str(s)))
+        idx_clu_returned.extend(idx_clu) # Allow to return the idx of each neurons on it's shank. Very important for traceability
+        shank.extend([s]*len(idx_clu))
+        for samples in spike_samples:
+            toreturn.append(nts.Tsd(t=samples/fs, time_units = 's'))
             #To return was change to nts.Tsd instead of nts.Ts as it has bug for priting (don't know where it is coming from)
 
-    del spikes
-    shank = np.hstack(shank)
+    shank = np.array(shank)
     
-    neurons = np.array(toreturn,dtype = 'object')
-    shanks = np.array([shank, idx_clu_returned]).T
+    neurons = np.empty(len(toreturn),dtype = 'object') #np.array would build a 2D array if all neurons had the same number of spikes
+    neurons[:] = toreturn
+    shanks = pd.DataFrame({'Shank':shank,'Id':idx_clu_returned})
+    if os.path.exists(path + '//' + session +'-metadata.npy'):
+        metadata = np.load(path+'//' + session +'-metadata.npy',allow_pickle=True)
+        if len(metadata) == len(neurons): shanks = pd.DataFrame(metadata,columns = ['Rat','Day','Shank','Id','Region','Type'])
     
     print()
-    print('Saving data in Numpy format :')
-    
-    print('Saving ' + session +'-neurons.npy')
-    np.save(path + '//' + session + '-neurons',neurons)
+    print('Saving data in SpikeStore format :')
+    print('Saving ' + session +'-spiketimes.npy')
+    store = convert_spike_store(path,session,neurons,shanks)
     
-    print('Saving ' + session +'-neuronsShanks.npy')
-    np.save(path + '//' + session + '-neuronsShanks',shanks)
-                      
+    if as_store: return store,shanks
     return neurons,shanks  #idx_clu is returned in order to keep indexing consistent with Matlab code.
 
-def loadLFP(path, n_channels=90, channel=64, frequency=1250.0, precision='int16'):
+class SpikeStore:
+    """
+    Spikes of all the neurons of a session in flat arrays (CSR layout) :
+        times : int64, spike times in us, neuron after neuron (sorted within each neuron)
+        offsets : int64, spikes of neuron i are times[offsets[i]:offsets[i+1]]
+        metadata : pd.DataFrame, one row per neuron
+    When loaded with load_spike_store the arrays are memory mapped, so the spikes of one neuron are a zero copy slice
+    and a full session is loaded without unpickling any object.
+    """
+    def __init__(self,times,offsets,metadata):
+        self.times = times
+        self.offsets = offsets
+        self.metadata = metadata
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return 'SpikeStore(' + str(len(self)) + ' neurons, ' + str(len(self.times)) + ' spikes)'
+
+    def spike_times(self,i):
+        #Spike times (us) of neuron i, zero copy
+        return self.times[self.offsets[i]:self.offsets[i+1]]
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def neuron(self,i):
+        return nts.Tsd(t = np.array(self.spike_times(i)),time_units = 'us')
+
+    def to_neurons(self):
+        #Array of nts.Tsd, as returned by loadSpikeData
+        neurons = np.empty(len(self),dtype = 'object')
+        for i in range(len(self)):
+            neurons[i] = self.neuron(i)
+        return neurons
+
+    def select(self,index):
+        #New SpikeStore (in memory) with a subset of neurons, index can be a boolean mask or an array of indices
+        index = np.arange(len(self))[np.asarray(index)]
+        counts = self.counts()[index]
+        offsets = np.zeros(len(index)+1,dtype = np.int64)
+        offsets[1:] = np.cumsum(counts)
+        if len(index):
+            times = np.concatenate([self.spike_times(i) for i in index])
+        else:
+            times = np.array([],dtype = np.int64)
+        return SpikeStore(times,offsets,self.metadata.iloc[index].reset_index(drop = True))
+
+def metadata_to_records(metadata):
+    #Convert a metadata DataFrame to a structured array that can be saved without pickle
+    metadata = pd.DataFrame(metadata).reset_index(drop = True).infer_objects()
+    columns = []
+    for c in metadata:
+        values = metadata[c].values
+        columns.append(values.astype(str) if values.dtype == object else values)
+    return np.rec.fromarrays(columns,names = [str(c) for c in metadata.columns]) if columns else np.array([])
+
+spike_store_suffixes = ['-spiketimes.npy','-spikeoffsets.npy','-spikemetadata.npy']
+
+def spike_store_arrays(neurons):
+    #times, offsets of the CSR layout of an array of nts.Tsd (or SpikeStore)
+    if isinstance(neurons,SpikeStore): return neurons.times,neurons.offsets
+    times = [np.asarray(neuron.index.values,dtype = np.int64) for neuron in neurons]
+    offsets = np.zeros(len(times)+1,dtype = np.int64)
+    offsets[1:] = np.cumsum([len(t) for t in times])
+    times = np.concatenate(times) if times else np.array([],dtype = np.int64)
+    return times,offsets
+
+def save_spike_store(path,session,neurons,metadata):
+    """
+    Save the spikes of a session as <session>-spiketimes.npy, <session>-spikeoffsets.npy and <session>-spikemetadata.npy
+    neurons : array of nts.Tsd (or SpikeStore)
+    metadata : pd.DataFrame with one row per neuron
+    The files are written under temporary names and renamed once all of them are written,
+    so an interrupted conversion never leaves a store that can be read.
+    """
+    times,offsets = spike_store_arrays(neurons)
+    arrays = dict(zip(spike_store_suffixes,[times,offsets,metadata_to_records(metadata)]))
+    filenames = {suffix:os.path.join(path,session + suffix) for suffix in spike_store_suffixes}
+    try:
+        for suffix in spike_store_suffixes:
+            with open(filenames[suffix] + '.tmp','wb') as f:
+                np.save(f,arrays[suffix],allow_pickle = False)
+        for suffix in spike_store_suffixes:
+            os.replace(filenames[suffix] + '.tmp',filenames[suffix])
+    finally:
+        for suffix in spike_store_suffixes:
+            if os.path.exists(filenames[suffix] + '.tmp'): os.remove(filenames[suffix] + '.tmp')
+
+def has_spike_store(path,session = None):
+    #True if the three files of the SpikeStore of the session exist
+    if session is None: session = session_name(path)
+    return all(os.path.exists(os.path.join(path,session + suffix)) for suffix in spike_store_suffixes)
+
+def convert_spike_store(path,session,neurons,metadata):
+    """
+    Save the spikes of a session in SpikeStore format and return the store (memory mapped).
+    If the session folder cannot be written (read only share ...) the store is built in memory instead.
+    """
+    try:
+        save_spike_store(path,session,neurons,metadata)
+    except OSError as e:
+        print('Could not save the SpikeStore in ' + path + ' (' + str(e) + '), keeping the spikes in memory')
+        return SpikeStore(*spike_store_arrays(neurons),metadata)
+    return load_spike_store(path,session)
+
+def load_spike_store(path,session = None,mmap_mode = 'r'):
+    #Return the SpikeStore of a session, or None if it was not saved yet (or only partially)
+    if session is None: session = session_name(path)
+    if not has_spike_store(path,session): return None
+    times = np.load(os.path.join(path,session + '-spiketimes.npy'),mmap_mode = mmap_mode)
+    offsets = np.load(os.path.join(path,session + '-spikeoffsets.npy'))
+    metadata = pd.DataFrame(np.load(os.path.join(path,session + '-spikemetadata.npy')))
+    return SpikeStore(times,offsets,metadata)
+
+metadata_columns = ['Rat','Day','Shank','Id','Region','Type']
+indexed_columns = ['Rat','Region','Type']
+
+def complete_metadata(metadata,path):
+    #Metadata of a session with all of metadata_columns, Rat and Day are taken from the session index when missing
+    metadata = pd.DataFrame(metadata).reset_index(drop = True)
+    if 'Rat' not in metadata or 'Day' not in metadata:
+        try: record = registry().get(path)
+        except (OSError,KeyError): record = {}
+    for c in metadata_columns:
+        if c in metadata: continue
+        metadata[c] = record.get(c,-1) if c in ('Rat','Day') else (-1 if c in ('Shank','Id') else '')
+    return metadata[metadata_columns].infer_objects()
+
+def build_consolidated_store(folder,paths = None,verbose = True):
+    """
+    Gather the spikes, metadata and states of many sessions (all the sessions of the index by default, or a list of paths
+    such as the one saved in sessions.pkl) in a single folder that ConsolidatedStore memory maps :
+        spiketimes.npy : int64, spike times (us) of all the neurons, neuron after neuron, session after session
+        spikeoffsets.npy : spikes of neuron i are spiketimes[offsets[i]:offsets[i+1]]
+        neurons.npy : one row per neuron, index of its session and metadata_columns
+        sessions.npy : Name, Path, Rat, Day, first neuron and number of neurons of each session
+        states.npz : for each state, (session, start, end) of every epoch (us)
+        indexes.npz : for the columns of indexed_columns, the neurons sorted by value with the offsets of each value
+    Spikes are copied session by session into the memory mapped output, the sessions are never all in memory.
+    """
+    if paths is None: paths = registry().paths
+    os.makedirs(folder,exist_ok = True)
+    
+    stores,tables,sessions_ = [],[],[]
+    epochs = {}
+    for i,p in enumerate(tqdm(paths,disable = not verbose)):
+        name = session_name(p)
+        store = load_spike_store(p,name)
+        if store is None: store = loadSpikeData(p,session = name,as_store = True)[0]
+        metadata = complete_metadata(store.metadata,p)
+        metadata.insert(0,'Session',i)
+        stores.append(store)
+        tables.append(metadata)
+        sessions_.append({'Name':name,'Path':p,'Rat':metadata['Rat'].iloc[0] if len(metadata) else -1,
+                          'Day':metadata['Day'].iloc[0] if len(metadata) else -1,'FirstNeuron':sum(len(s) for s in stores[:-1]),'NNeurons':len(store)})
+        for state,intervals in states(p).items():
+            intervals = np.column_stack([np.full(len(intervals),i),intervals['start'].values,intervals['end'].values])
+            epochs.setdefault(state,[]).append(intervals.astype(np.int64))
+    
+    n_spikes = [len(store.times) for store in stores]
+    times = np.lib.format.open_memmap(os.path.join(folder,'spiketimes.npy'),'w+',np.int64,(sum(n_spikes),))
+    offsets = np.zeros(sum(len(store) for store in stores)+1,dtype = np.int64)
+    first_spike,first_neuron = 0,0
+    for store,n in zip(stores,n_spikes):
+        times[first_spike:first_spike+n] = store.times
+        offsets[first_neuron+1:first_neuron+len(store)+1] = store.offsets[1:] + first_spike
+        first_spike += n
+        first_neuron += len(store)
+    times.flush()
+    del times
+    np.save(os.path.join(folder,'spikeoffsets.npy'),offsets)
+    
+    neurons = pd.concat(tables,ignore_index = True) if tables else pd.DataFrame(columns = ['Session'] + metadata_columns)
+    np.save(os.path.join(folder,'neurons.npy'),metadata_to_records(neurons),allow_pickle = False)
+    np.save(os.path.join(folder,'sessions.npy'),metadata_to_records(pd.DataFrame(sessions_)),allow_pickle = False)
+    np.savez(os.path.join(folder,'states.npz'),**{state:np.concatenate(e) for state,e in epochs.items()})
+    
+    indexes = {}
+    for c in indexed_columns:
+        values,inverse = np.unique(neurons[c].values.astype(str),return_inverse = True)
+        indexes[c+'_values'] = values
+        indexes[c+'_order'] = np.argsort(inverse,kind = 'stable')
+        indexes[c+'_offsets'] = np.concatenate([[0],np.cumsum(np.bincount(inverse,minlength = len(values)))])
+    np.savez(os.path.join(folder,'indexes.npz'),**indexes)
+
+class ConsolidatedStore:
+    """
+    Spikes, metadata and states of many sessions, as written by build_consolidated_store.
+    Spike times are memory mapped, a query only reads the spikes of the neurons it returns.
+    
+    Example :
+        store = bk.load.ConsolidatedStore('Z:/All-Rats/Billel/consolidated')
+        neurons,metadata = store.load(regions = 'BLA',types = 'Pyr')
+    """
+    def __init__(self,folder,mmap_mode = 'r'):
+        self.folder = folder
+        self.times = np.load(os.path.join(folder,'spiketimes.npy'),mmap_mode = mmap_mode)
+        self.offsets = np.load(os.path.join(folder,'spikeoffsets.npy'))
+        self.metadata = pd.DataFrame(np.load(os.path.join(folder,'neurons.npy')))
+        self.sessions = pd.DataFrame(np.load(os.path.join(folder,'sessions.npy')))
+        with np.load(os.path.join(folder,'indexes.npz')) as indexes:
+            self.indexes = {c:(indexes[c+'_values'],indexes[c+'_order'],indexes[c+'_offsets']) for c in indexed_columns}
+        with np.load(os.path.join(folder,'states.npz')) as epochs:
+            self.epochs = {state:epochs[state] for state in epochs.files}
+        self.store = SpikeStore(self.times,self.offsets,self.metadata)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return 'ConsolidatedStore(' + str(len(self.sessions)) + ' sessions, ' + str(len(self)) + ' neurons)'
+
+    def lookup(self,column,values):
+        #Sorted indices of the neurons with column (one of indexed_columns) in values, read from the index
+        keys,order,offsets = self.indexes[column]
+        found = [np.array([],dtype = np.int64)]
+        for value in np.atleast_1d(values).astype(str):
+            k = np.searchsorted(keys,value)
+            if k < len(keys) and keys[k] == value: found.append(order[offsets[k]:offsets[k+1]])
+        return np.sort(np.concatenate(found))
+
+    def session_index(self,session):
+        #Row of the session in self.sessions, from its name, path or row
+        if isinstance(session,(int,np.integer)): return int(session)
+        return int(np.flatnonzero(self.sessions['Name'].values == session_name(session))[0])
+
+    def query(self,rats = None,regions = None,types = None,sessions = None):
+        """
+        Indices of the neurons matching every criterion (None for any, a value or a list of values).
+        sessions : names, paths or rows of sessions
+        """
+        index = np.arange(len(self))
+        for column,values in zip(indexed_columns,(rats,regions,types)):
+            if values is not None: index = np.intersect1d(index,self.lookup(column,values),assume_unique = True)
+        if sessions is not None:
+            rows = [self.session_index(s) for s in np.atleast_1d(sessions)]
+            first = self.sessions['FirstNeuron'].values[rows]
+            index = np.intersect1d(index,np.concatenate([np.arange(f,f+n) for f,n in zip(first,self.sessions['NNeurons'].values[rows])] + [np.array([],dtype = np.int64)]),assume_unique = True)
+        return index
+
+    def load(self,rats = None,regions = None,types = None,sessions = None,as_store = False):
+        #Neurons matching the query (array of nts.Tsd, or SpikeStore) and their metadata (with the index of their session)
+        store = self.store.select(self.query(rats,regions,types,sessions))
+        if as_store: return store,store.metadata
+        return store.to_neurons(),store.metadata
+
+    def states(self,session):
+        #States of one session, as bk.load.states
+        row = self.session_index(session)
+        states_ = {}
+        for state,epochs in self.epochs.items():
+            epochs = epochs[epochs[:,0] == row]
+            states_[state] = nts.IntervalSet(epochs[:,1],epochs[:,2],time_units = 'us')
+        return states_
+
+def load_metadata(path,session = None):
+    """
+    Metadata of the neurons of a session (one row per neuron, same order as loadSpikeData) without reading any spike :
+    from -spikemetadata.npy if the SpikeStore exists, otherwise from -metadata.npy.
+    Sessions with neither are loaded once with loadSpikeData, which saves the SpikeStore.
+    """
+    if session is None: session = session_name(path)
+    if has_spike_store(path,session):
+        return pd.DataFrame(np.load(os.path.join(path,session + '-spikemetadata.npy')))
+    filename = os.path.join(path,session + '-metadata.npy')
+    if os.path.exists(filename) and os.path.exists(os.path.join(path,session + '-neurons.npy')):
+        return pd.DataFrame(np.load(filename,allow_pickle = True),columns = ['Rat','Day','Shank','Id','Region','Type'])
+    return loadSpikeData(path,session = session,as_store = True)[1]
+
+def neuron_mask(metadata,types = None,regions = None):
+    #Boolean mask of the neurons of metadata with a Type in types and a Region in regions (str or list, None for any)
+    mask = np.ones(len(metadata),dtype = bool)
+    if types is not None: mask &= metadata['Type'].isin(np.atleast_1d(types)).values
+    if regions is not None: mask &= metadata['Region'].isin(np.atleast_1d(regions)).values
+    return mask
+
+def load_neurons(path,index = None,session = None,types = None,regions = None,as_store = False):
+    """
+    Load only some neurons of a session, selected on the metadata before any spike is read.
+    index : boolean mask or indices of the neurons (in the order of load_metadata), combined with types and regions
+    Spikes are read from the memory mapped SpikeStore, so only the selected neurons are read from disk
+    (the store is created by loadSpikeData the first time).
+    
+    Return array of nts.Tsd (or SpikeStore), metadata of the selected neurons
+    """
+    if session is None: session = session_name(path)
+    store = load_spike_store(path,session)
+    if store is None: store = loadSpikeData(path,session = session,as_store = True)[0]
+    
+    mask = neuron_mask(store.metadata,types,regions)
+    if index is not None:
+        selected = np.zeros(len(store),dtype = bool)
+        selected[np.arange(len(store))[np.asarray(index)]] = True
+        mask &= selected
+    store = store.select(mask)
+    if as_store: return store,store.metadata
+    return store.to_neurons(),store.metadata
+
+def read_integers(filename,chunksize = 5_000_000):
+    #Parse a text file with one integer per line (.clu / .res) with the C parser of pandas, by chunks to bound memory.
+    chunks = [chunk.values.ravel() for chunk in pd.read_csv(filename,header = None,dtype = np.int64,engine = 'c',chunksize = chunksize)]
+    if not chunks: return np.array([],dtype = np.int64)
+    return np.concatenate(chunks)
+
+def read_clu_res(clu_file,res_file):
+    """
+    Read a pair of .clu.N / .res.N files.
+    Clusters 0 (artefacts) and 1 (noise) are dropped.
+    The spikes are grouped by cluster with a single sort, without building a time * cluster table.
+    
+    Return
+        idx_clu : id of each cluster on the shank
+        spike_samples : list of arrays (one per cluster) of sorted, unique spike times in samples
+    """
+    clu = read_integers(clu_file)[1:] #First line is the number of clusters
+    if len(clu) == 0 or np.max(clu) <= 1: return np.array([],dtype = int),[]
+    res = read_integers(res_file)
+    
+    keep = clu > 1
+    clu = clu[keep]
+    res = res[keep]
+    order = np.lexsort((res,clu))
+    clu = clu[order]
+    res = res[order]
+    
+    #Same spike time twice in a cluster was merged by the previous (dense table) implementation, keep this behaviour
+    duplicate = np.zeros(len(clu),dtype = bool)
+    duplicate[1:] = (np.diff(clu) == 0) & (np.diff(res) == 0)
+    clu = clu[~duplicate]
+    res = res[~duplicate]
+    
+    idx_clu,first = np.unique(clu,return_index = True)
+    return idx_clu,np.split(res,first[1:])
+
+class LFPReader:
+    """
+    Memory map of a .lfp file (int16, samples * n_channels), opened on first use and reused for every read.
+    Only the requested samples and channels are copied in memory.
+    close releases the file, the next read opens it again. Reads and close are serialized by a lock,
+    so that a map is never closed while another thread copies from it.
+    """
+    def __init__(self,filename,n_channels,frequency = 1250.0):
+        self.filename = filename
+        self.n_channels = n_channels
+        self.frequency = frequency
+        self.lock = threading.RLock()
+        self.memmap = None
+        self.data = None
+
+    def open(self):
+        #(samples, n_channels) view of the memory map, (re)opened if needed. Call with self.lock held.
+        if self.data is None:
+            self.memmap = np.memmap(self.filename,np.int16,'r')
+            self.data = self.memmap[:len(self.memmap)//self.n_channels*self.n_channels].reshape(-1,self.n_channels)
+        return self.data
+
+    def close(self):
+        #Close the memory map so that the file can be deleted or replaced (on Windows an open map locks the file).
+        #np.memmap has no public close, its file is only released when every view of it is garbage collected.
+        #Reads return copies, so no array outside of the reader points to the map and the mmap.mmap that numpy keeps
+        #in _mmap can be closed explicitly (when a numpy version does not have it, dropping the views is all we can do).
+        with self.lock:
+            if self.memmap is None: return
+            mmap = getattr(self.memmap,'_mmap',None)
+            self.data = None
+            self.memmap = None
+            if mmap is not None: mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.open())
+
+    @property
+    def duration(self):
+        return len(self)/self.frequency
+
+    def samples(self,start,stop):
+        #Index of the first and last (excluded) sample between start and stop (s), clipped to the file
+        first = int(np.clip(np.round(start*self.frequency),0,len(self)))
+        last = int(np.clip(np.round(stop*self.frequency),first,len(self)))
+        return first,last
+
+    def read(self,start,stop,channel,step = 1):
+        #Return time (s) and data between start and stop (s). channel can be an int or a list, step > 1 keeps one sample every step.
+        with self.lock:
+            first,last = self.samples(start,stop)
+            return np.arange(first,last,step)/self.frequency,np.array(self.open()[first:last:step,channel])
+
+    def read_intervals(self,intervals,channel,step = 1):
+        """
+        Read all the intervals of an nts.IntervalSet in one pass into preallocated arrays.
+        Return time (s) and data (samples, or samples * channels if channel is a list)
+        """
+        intervals = intervals.as_units('s')
+        with self.lock:
+            ranges = [self.samples(start,stop) for start,stop in zip(intervals.start,intervals.end)]
+            sizes = [len(range(first,last,step)) for first,last in ranges]
+            
+            t = np.empty(sum(sizes))
+            shape = (sum(sizes),len(channel)) if type(channel) is list else (sum(sizes),)
+            data = np.empty(shape,dtype = np.int16)
+            i = 0
+            for (first,last),size in zip(ranges,sizes):
+                t[i:i+size] = np.arange(first,last,step)/self.frequency
+                data[i:i+size] = self.open()[first:last:step,channel]
+                i += size
+        return t,data
+
+lfp_readers = {}
+lfp_readers_lock = threading.Lock()
+
+def lfp_reader(filename,n_channels,frequency = 1250.0):
+    #Return the LFPReader of a file, the memory map is created only once per file (until release_lfp_readers)
+    key = (os.path.abspath(filename),n_channels,frequency)
+    with lfp_readers_lock:
+        if key not in lfp_readers:
+            lfp_readers[key] = LFPReader(filename,n_channels,frequency)
+        return lfp_readers[key]
+
+def release_lfp_readers(session_path = None):
+    #Close the LFPReaders of the files in session_path (all the readers if None), they are opened again by the next read
+    folder = None if session_path is None else os.path.abspath(session_path)
+    with lfp_readers_lock:
+        for key in list(lfp_readers):
+            if folder is None or os.path.dirname(key[0]) == folder:
+                lfp_readers.pop(key).close()
+
+def loadLFP(path, n_channels=90, channel=64, frequency=1250.0, precision='int16', step = 1):
     #From Guillaume Viejo
-    import neuroseries as nts
+    #Read through a memory map so that only the selected channels are loaded in memory. step > 1 decimates the signal.
+    with LFPReader(path,n_channels,frequency) as reader:
+        timestep,data = reader.read(0,np.inf,channel,step)
     if type(channel) is not list:
-        f = open(path, 'rb')
-        startoffile = f.seek(0, 0)
-        endoffile = f.seek(0, 2)
-        bytes_size = 2
-        n_samples = int((endoffile-startoffile)/n_channels/bytes_size)
-        duration = n_samples/frequency
-        interval = 1/frequency
-        f.close()
-        with open(path, 'rb') as f:
-            print('opening')
-            data = np.fromfile(f, np.int16).reshape((n_samples, n_channels))[:,channel]
-            timestep = np.arange(0, len(data))/frequency
         return nts.Tsd(timestep, data, time_units = 's')
-    elif type(channel) is list:
-        f = open(path, 'rb')
-        startoffile = f.seek(0, 0)
-        endoffile = f.seek(0, 2)
-        bytes_size = 2
-
-        n_samples = int((endoffile-startoffile)/n_channels/bytes_size)
-        duration = n_samples/frequency
-        f.close()
-        with open(path, 'rb') as f:
-            data = np.fromfile(f, np.int16).reshape((n_samples, n_channels))[:,channel]
-            timestep = np.arange(0, len(data))/frequency
-        return nts.TsdFrame(timestep, data, time_units = 's')
-
-def lfp(start, stop, n_channels=90, channel=64, frequency=1250.0, precision='int16',verbose = False):
-    
-    p = session+".lfp"
+    return nts.TsdFrame(timestep, data, time_units = 's')
+
+def lfp(start, stop, n_channels=90, channel=64, frequency=1250.0, precision='int16',verbose = False,session_path = None,step = 1):
+    
+    if session_path is None: p = session+".lfp"
+    else: p = os.path.join(session_path,session_name(session_path)+".lfp")
     if verbose:
         print('Load LFP from ' + p)
     # From Guillaume viejo
-    import neuroseries as nts
-    bytes_size = 2
-    start_index = int(start*frequency*n_channels*bytes_size)
-    stop_index = int(stop*frequency*n_channels*bytes_size)
-    #In order not to read after the file
-    if stop_index > os.path.getsize(p): stop_index = os.path.getsize(p)
-    fp = np.memmap(p, np.int16, 'r', start_index, shape = (stop_index - start_index)//bytes_size)
-    data = np.array(fp).reshape(len(fp)//n_channels, n_channels)
+    timestep,data = lfp_reader(p,n_channels,frequency).read(start,stop,channel,step)
 
     if type(channel) is not list:
-        timestep = np.arange(0, len(data))/frequency+start
-        return nts.Tsd(timestep, data[:,channel], time_units = 's')
-    elif type(channel) is list:
-        timestep = np.arange(0, len(data))/frequency+start
-        return nts.TsdFrame(timestep, data[:,channel], time_units = 's')
-
-def lfp_in_intervals(nchannels,channel,intervals):
-    t = np.array([])
-    lfps = np.array([])
+        return nts.Tsd(timestep, data, time_units = 's')
+    return nts.TsdFrame(timestep, data, time_units = 's')
 
-    for start,stop in zip(intervals.as_units('s').start,intervals.as_units('s').end):
-        start = np.round(start,decimals = 1)
-        stop = np.round(stop,decimals = 1)
-        lfp = bk.load.lfp(start,stop,nchannels,channel)
-        t = np.append(t,lfp.index)
-        lfps = np.append(lfps,lfp.values)
+def lfp_in_intervals(nchannels,channel,intervals,step = 1,session_path = None):
+    #Load the lfp of all intervals in one pass (one memory map, preallocated output)
+    if session_path is None: p = session+".lfp"
+    else: p = os.path.join(session_path,session_name(session_path)+".lfp")
+    t,lfps = lfp_reader(p,nchannels).read_intervals(intervals,channel,step)
 
-
-    lfps = nts.Tsd(t,lfps)
-    
-    return lfps    
+    if type(channel) is list:
+        return nts.TsdFrame(t,lfps,time_units = 's')
+    return nts.Tsd(t,lfps,time_units = 's')
 
 
 #####
 
-def digitalin(path,nchannels=16,Fs = 20000):
-    import pandas as pd
+def digitalin(path,nchannels=16,Fs = 20000,channels = None,chunk_size = 10_000_000):
+    """
+    Decode digitalin.dat (one uint16 word per sample, one bit per channel).
+    The file is memory mapped and decoded by chunks, only the requested channels are materialized.
     
-    digital_word = np.fromfile(path,'uint16')
-    sample = len(digital_word)
-    time = np.arange(0,sample)
-    time = time/Fs
-
+    channels : int or list of channels to decode (default all nchannels)
+    Return bool array channels * samples (samples if channels is an int)
+    """
+    digital_word = np.memmap(path,np.uint16,'r')
+    single = np.isscalar(channels)
+    if channels is None: channels = range(nchannels)
+    channels = [channels] if single else list(channels)
     
-    for i in range(nchannels):
-        if i == 0: data = (digital_word & 2**i)>0
-        else: data = np.vstack((data,(digital_word & 2**i)>0))
-
+    data = np.empty((len(channels),len(digital_word)),dtype = bool)
+    for start in range(0,len(digital_word),chunk_size):
+        chunk = digital_word[start:start+chunk_size]
+        for k,c in enumerate(channels):
+            np.not_equal(chunk & np.uint16(1 << c),0,out = data[k,start:start+len(chunk)])
+    
+    if single: return data[0]
     return data
+
+def digitalin_edges(path,channels,Fs = 20000,chunk_size = 10_000_000):
+    """
+    Rising and falling edges of digital channels, computed in a single streaming pass over the memory mapped digitalin.dat,
+    without materializing the boolean channels.
+    Same convention as bk.compute.TTL_edge_index : a channel high at the beginning (end) of the file starts at the first (ends at the last) sample.
+    
+    channels : list of channels
+    Return dict {channel : (t_start,t_end)} in s
+    """
+    digital_word = np.memmap(path,np.uint16,'r')
+    starts = {c:[np.array([],dtype = np.int64)] for c in channels}
+    ends = {c:[np.array([],dtype = np.int64)] for c in channels}
+    previous = {c:0 for c in channels}
+    for offset in range(0,len(digital_word),chunk_size):
+        chunk = digital_word[offset:offset+chunk_size]
+        for c in channels:
+            bits = (chunk & np.uint16(1 << c)) != 0
+            rising,falling = bk.compute.TTL_changes(bits,previous[c],offset)
+            starts[c].append(rising)
+            ends[c].append(falling)
+            previous[c] = int(bits[-1])
+    
+    edges = {}
+    for c in channels:
+        t_start = np.maximum(np.concatenate(starts[c]),0)
+        t_end = np.concatenate(ends[c])
+        if previous[c]: t_end = np.append(t_end,len(digital_word)-1)
+        edges[c] = (t_start/Fs,t_end/Fs)
+    return edges
     
-def freezing_intervals():
-    if os.path.exists('freezing_intervals.npy'):
-        freezing_intervals = np.load('freezing_intervals.npy')
+def freezing_intervals(session_path = None):
+    session_path = session_folder(session_path)
+    filename = os.path.join(session_path,'freezing_intervals.npy')
+    if os.path.exists(filename):
+        freezing_intervals = np.load(filename)
         return nts.IntervalSet(start = freezing_intervals[:,0], end = freezing_intervals[:,1])
     else:
         print('Could not find freezing_intervals.npy')
@@ -372,39 +1118,83 @@ def freezing_intervals():
     
     
     
-def DLC_pos(filtered = True,force_reload = False, save = False):
-    """
-    Load position from DLC files (*.h5) and returns it as a nts.TsdFrame
-    """
-    files = os.listdir()
-    if ('positions.h5' in files) and (force_reload == False):
-        data = pd.read_hdf('positions.h5')
-        pos = nts.TsdFrame(data)
-        return pos
-
-    for f in files:
-        if filtered and f.endswith('filtered.h5'): 
-            filename = f
-            break
-        if not filtered and not f.endswith('filtered.h5') and f.endswith('.h5'):
-            filename = f
-            break
+def dlc_file(session_path,filtered = True):
+    #DLC output (*.h5) of the session, the filtered one if filtered
+    for f in sorted(os.listdir(session_path)):
+        if f == 'positions.h5' or not f.endswith('.h5'): continue
+        if f.endswith('filtered.h5') == filtered: return os.path.join(session_path,f)
+    raise FileNotFoundError('No DLC file in ' + session_path)
 
-    data = pd.read_hdf(filename)
-    data = data[data.keys()[0][0]]
+def frame_times(session_path = None,channel = 0,Fs = 20000):
+    #Times of the camera frames (middle of the TTL pulses, s), from a streaming pass over one channel of digitalin.dat
+    if session_path is None: session_path = os.getcwd()
+    t_start,t_end = digitalin_edges(os.path.join(session_path,'digitalin.dat'),[channel],Fs)[channel]
+    return (t_start + t_end)/2
 
-    TTL = digitalin('digitalin.dat')[0,:]
-    tf = bk.compute.TTL_to_times(TTL)
+def dlc_arrays(data):
+    #Names of the body parts and float32 array (frames, body parts, 3) for x, y and likelihood of a DLC frame with columns (body part, coord)
+    parts = np.array(data.columns.get_level_values(0).unique(),dtype = str)
+    columns = pd.MultiIndex.from_product([parts,['x','y','likelihood']])
+    return parts,data.reindex(columns = columns).values.astype(np.float32).reshape(len(data),len(parts),3)
 
-    if len(tf)>len(data):
-        tf = np.delete(tf,-1)
-
-    data.index = tf * 1_000_000
+def dlc_positions(session_path = None,filtered = True,force_reload = False,save = False):
+    """
+    Positions of the DLC file aligned on the camera TTLs, as arrays :
+        t : times of the frames (int64, us)
+        parts : names of the body parts
+        coords : float32 array (frames, body parts, 3) for x, y and likelihood
+    With save, they are cached in positions.npz (one array per column) with the size and mtime of the DLC file and of digitalin.dat,
+    an existing positions.npz is used as long as none of them changed.
+    Sessions that only have the positions.h5 saved by the previous version of DLC_pos are read from it.
+    """
+    if session_path is None: session_path = os.getcwd()
+    try:
+        source = dlc_file(session_path,filtered)
+    except FileNotFoundError:
+        if not os.path.exists(os.path.join(session_path,'positions.h5')): raise
+        data = pd.read_hdf(os.path.join(session_path,'positions.h5'))
+        parts,coords = dlc_arrays(data)
+        return np.round(data.index.values).astype(np.int64),parts,coords
+    
+    fingerprint = np.concatenate([bk.compute.file_fingerprint(source),bk.compute.file_fingerprint(os.path.join(session_path,'digitalin.dat'))])
+    cache_file = os.path.join(session_path,'positions.npz')
+    
+    if os.path.exists(cache_file) and not force_reload:
+        with np.load(cache_file) as cache:
+            if np.array_equal(cache['fingerprint'],fingerprint) and cache['source'] == os.path.basename(source):
+                return cache['t'],cache['parts'],cache['coords']
+    
+    data = pd.read_hdf(source)
+    parts,coords = dlc_arrays(data[data.keys()[0][0]])
+    del data
+    
+    t = frame_times(session_path)
+    #Extra TTLs after the last frame (or frames after the last TTL) are dropped
+    n = min(len(t),len(coords))
+    t = np.round(t[:n]*1_000_000).astype(np.int64)
+    coords = coords[:n]
     
     if save:
-        data.to_hdf('positions.h5','pos')
-        
-    pos = nts.TsdFrame(data)
+        np.savez(cache_file,fingerprint = fingerprint,source = os.path.basename(source),t = t,parts = parts,coords = coords)
+    return t,parts,coords
+
+def DLC_pos(filtered = True,force_reload = False, save = False, session_path = None, likelihood = None):
+    """
+    Load position from DLC files (*.h5) and returns it as a nts.TsdFrame (columns (body part, x/y/likelihood), float32)
+    Positions are read from the positions.npz cache when it is up to date, save writes it (see dlc_positions)
+    likelihood : if not None, x and y of the frames where the likelihood of a body part is below this value
+                 are interpolated from the neighbouring frames of that body part (so that the output can go into bk.compute.speed)
+    """
+    t,parts,coords = dlc_positions(session_path,filtered,force_reload,save)
+    if likelihood is not None:
+        xy = coords[...,:2].astype(np.float64)
+        xy[coords[...,2] < likelihood] = np.nan
+        coords = coords.copy()
+        coords[...,:2] = bk.compute.interpolate_nan(t,xy)
+    
+    columns = pd.MultiIndex.from_product([parts,['x','y','likelihood']])
+    pos = nts.TsdFrame(t = t,d = coords.reshape(len(t),-1),columns = columns)
     return pos
 
+
        
\ No newline at end of file
@@ -1,11 +1,16 @@
+import os
+from functools import partial
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import bk.load
+import bk.compute
+import bk.intervals
 
 def categorize_types_regions(session, brain_region):
     ''' 
     Categorizes neurons of session according to their physiology and location.
+    The neurons are selected on the metadata first, only the spikes of the selected neurons are loaded.
     Keyword arguments:
     session -- string, path to the directory where the useful files are saved.
     brain_region -- string, brain region of interest. Can be 'BLA' or 'Hpc'
@@ -13,11 +18,40 @@ def categorize_types_regions(session, brain_region):
     3 numpy ndarrays, each corresponding to a different kind of cell.
      '''
     bk.load.current_session(session)
-    neurons, metadata = bk.load.loadSpikeData(session)
-    pyramidal = neurons[(metadata['Type']=='Pyr') & (metadata['Region']==brain_region)]
-    interneurons = neurons[(metadata['Type']=='Int') & (metadata['Region']==brain_region)]
-    other_neurons = neurons[metadata['Type']=='Unk']
-    return pyramidal, interneurons, other_neurons
+    metadata = bk.load.load_metadata(session)
+    categories = [bk.load.neuron_mask(metadata, 'Pyr', brain_region), bk.load.neuron_mask(metadata, 'Int', brain_region), bk.load.neuron_mask(metadata, 'Unk')]
+    selected = np.logical_or.reduce(categories)
+    neurons, _ = bk.load.load_neurons(session, selected)
+    return tuple(neurons[category[selected]] for category in categories)
+
+def firing_rate_matrix(neurons, states=None):
+    """
+    Returns a pandas DataFrame with the mean firing rate of each neuron (rows) during each state (columns).
+    All spikes of the session are concatenated in one sorted array, so every state is counted in a single vectorized pass.
+
+    Keyword arguments:
+    neurons -- numpy.ndarray, containing series data of selected neurons
+    states -- dict of nts.IntervalSet, as returned by bk.load.states() (default=None, the states of the current session)
+
+    Outputs:
+    A pd.DataFrame of shape number of neurons * number of states containing the mean firing rates (Hz).
+    Rates during a state that has a total length of 0 are NaN.
+    """
+    if states is None:
+        states = bk.load.states()
+    times, ids = bk.compute.concatenate_spikes(neurons)
+    rates = np.full((len(neurons), len(states)), np.nan)
+
+    for j, state in enumerate(states):
+        intervals = bk.intervals.normalize(bk.intervals.from_nts(states[state]))
+        duration = bk.intervals.tot_length(intervals)/1_000_000
+        if duration == 0:
+            continue
+        # Spikes in (start, end], same convention as nts restrict
+        inside = bk.intervals.restrict_mask(times, intervals)
+        rates[:, j] = np.bincount(ids[inside], minlength=len(neurons))/duration
+    return pd.DataFrame(rates, columns=list(states))
+
 
 def calculate_firing_rate_per_state(neurons, state):
     """
@@ -33,16 +67,69 @@ def calculate_firing_rate_per_state(neurons, state):
     Restrictions:
     Can only be called when the neurons and session have already been loaded.
     """
-    mean_firing_rates = pd.Series(index = np.arange(len(neurons)),dtype='float64')
     state_used = bk.load.states()[state]
+    return firing_rate_matrix(neurons, {state: state_used})[state]
+
 
-    for i in range(len(neurons)):
+def source_fingerprint(path, session_name):
+    '''
+    Returns the modification time (ns) and size (bytes) of the files the firing rates of a session are computed from.
+    
+    Keyword arguments:
+    path -- string, path to the directory of the session
+    session_name -- string, name of the session (e.g. 'Rat08-20130713')
+    
+    Output:
+    np.array of int64, (mtime, size) of States.mat, -neurons.npy, -metadata.npy and -spiketimes.npy. Missing files are recorded as (-1, -1).
+    '''
+    fingerprint=[]
+    for file in ['States.mat', session_name+'-neurons.npy', session_name+'-metadata.npy', session_name+'-spiketimes.npy']:
         try:
-            spk_time = neurons[i].restrict(state_used).as_units('ms').index.values
-            mean_firing_rates[i] = len(spk_time)/state_used.tot_length('s')
-        except Exception:
-            pass #using this exeption because not all neurons have spikes in all states (represented by NaN values). The NaN values cannot be used to calculate firing rates.
-    return mean_firing_rates
+            stat=os.stat(os.path.join(path, file))
+            fingerprint.extend([stat.st_mtime_ns, stat.st_size])
+        except FileNotFoundError:
+            fingerprint.extend([-1, -1])
+    return np.array(fingerprint, dtype=np.int64)
+
+
+def session_firing_rates(session, force_reload=False):
+    '''
+    Returns a pandas DataFrame with one row per neuron of the session: its metadata (Rat, Day, Shank, Id, Region, Type) followed by its mean firing rate during every state of bk.load.states().
+    The table is cached in <session name>-firingrates.npz in the session directory (when it is writable) and only recomputed when the fingerprint of its source files changed.
+    Spikes are read from the SpikeStore of the session (memory mapped) instead of building one nts.Tsd per neuron.
+    
+    Keyword arguments:
+    session -- string, path to the directory where the useful files are saved.
+    force_reload -- boolean, recompute the table even if a valid cache exists (default=False)
+    '''
+    bk.load.current_session(session)
+    cache_file=os.path.join(bk.load.path, bk.load.session+'-firingrates.npz')
+
+    if os.path.exists(cache_file) and not force_reload:
+        with np.load(cache_file) as cache:
+            if np.array_equal(cache['fingerprint'], source_fingerprint(bk.load.path, bk.load.session)):
+                table=pd.DataFrame({column: cache['meta_'+column] for column in cache['columns']})
+                rates=pd.DataFrame(cache['rates'], columns=cache['states'])
+                return pd.concat([table, rates], axis=1)
+
+    neurons, metadata = bk.load.loadSpikeData(bk.load.path, as_store=True)
+    metadata=metadata.reset_index(drop=True).infer_objects()
+    rates=firing_rate_matrix(neurons)
+
+    # Object columns are saved as fixed width strings so that the cache can be read back without pickle
+    arrays={'fingerprint': source_fingerprint(bk.load.path, bk.load.session),
+            'columns': np.array(metadata.columns, dtype=str),
+            'states': np.array(rates.columns, dtype=str),
+            'rates': rates.values}
+    for column in metadata:
+        values=metadata[column].values
+        arrays['meta_'+column]=values.astype(str) if values.dtype==object else values
+    # A read-only session folder (shared drive) is supported, the table is then returned without being cached
+    try:
+        np.savez(cache_file, **arrays)
+    except OSError as e:
+        print('Could not save the firing rates in '+cache_file+' ('+str(e)+'), returning them without caching')
+    return pd.concat([metadata, rates], axis=1)
 
 
 def calculate_firing_rate_per_state_per_type(session, states, brain_region):
@@ -53,18 +140,54 @@ def calculate_firing_rate_per_state_per_type(session, states, brain_region):
     session -- string, containing the dircetory where the data files are stored
     states -- list of 2 strings, should be one of the following: REM, sws, drowsy, wake (default='REM')
     '''
-    neurons_by_type=categorize_types_regions(session, brain_region)
+    table=session_firing_rates(session)
+    pyramidal=table[(table['Type']=='Pyr') & (table['Region']==brain_region)]
+    interneurons=table[(table['Type']=='Int') & (table['Region']==brain_region)]
+    other_neurons=table[table['Type']=='Unk']
     firing_rates_state0=[]
     firing_rates_state1=[]
-    for i in neurons_by_type:
-        state0=calculate_firing_rate_per_state(i, states[0])
-        state1=calculate_firing_rate_per_state(i, states[1])
-        firing_rates_state0.append(state0)
-        firing_rates_state1.append(state1)
+    for i in [pyramidal, interneurons, other_neurons]:
+        firing_rates_state0.append(i[states[0]].reset_index(drop=True))
+        firing_rates_state1.append(i[states[1]].reset_index(drop=True))
     return firing_rates_state0, firing_rates_state1
 
 
-def calculate_firing_rates_multiple_sessions(sessions, states, brain_region):
+def run_sessions(func, sessions, n_workers=1, cache=None):
+    '''
+    Runs func on every session and returns its outputs and errors, both keyed by session name in the order of sessions.
+    A session that raises is reported and skipped, whether the sessions are run serially or in parallel.
+    
+    Keyword arguments:
+    func -- function taking the path of a session (picklable when n_workers > 1)
+    sessions -- list of strings, containing the dircetories where the data files for each sessions are stored
+    n_workers -- integer, number of processes the sessions are dispatched to, 1 runs them serially (default=1)
+    cache -- bk.load.SessionCache, serial runs read the local copy of each session while the next one is prefetched (default=None, bk.load.session_cache)
+    
+    Outputs:
+    outputs -- dict {session name: output of func}
+    errors -- dict {session name: traceback}
+    '''
+    if n_workers==1:
+        if cache is None:
+            cache=bk.load.session_cache
+        outputs={}
+        errors={}
+        for session in (sessions if cache is None else cache.prefetched(sessions)):
+            name=bk.load.session_name(session)
+            success, output=bk.load.run_session(func, session)
+            if success:
+                outputs[name]=output
+            else:
+                errors[name]=output
+                print('Error in session '+name)
+    else:
+        outputs, errors=bk.load.batch_parallel(func, sessions, n_workers)
+    if errors:
+        print('Sessions not processed: '+', '.join(errors))
+    return outputs, errors
+
+
+def calculate_firing_rates_multiple_sessions(sessions, states, brain_region, n_workers=1, cache=None, return_errors=False):
     '''
     Returns N numpy arrays (one for each state) with the mean firing rate of each of the types of neurons (Pyramidal, interneurons, unknown) during the chosen state
     where N is the number of sessions.
@@ -73,16 +196,221 @@ def calculate_firing_rates_multiple_sessions(sessions, states, brain_region):
     Keyword arguments:
     sessions -- list of strings, containing the dircetories where the data files for each sessions are stored
     states -- list of 2 strings, should be one of the following: REM, sws, drowsy, wake (default='REM')
-    '''
+    n_workers -- integer, number of processes the sessions are dispatched to, 1 runs them serially (default=1). Sessions that fail are reported and skipped (see run_sessions).
+    cache -- bk.load.SessionCache, serial runs read the local copy of each session while the next one is prefetched (default=None, bk.load.session_cache)
+    return_errors -- boolean, also return the dict {session name: traceback} of the sessions that failed (default=False)
     
+    Outputs:
+    The rows follow the order of sessions, without the sessions that failed.
+    '''
+    outputs, errors=run_sessions(partial(calculate_firing_rate_per_state_per_type, states=states, brain_region=brain_region), sessions, n_workers, cache)
     all_sessions_state0=[]
     all_sessions_state1=[]
-
-    for session in sessions:
-        FR_per_cell_state0,FR_per_cell_state1=calculate_firing_rate_per_state_per_type(session, states, brain_region)
+    for FR_per_cell_state0,FR_per_cell_state1 in outputs.values():
         all_sessions_state0.append(FR_per_cell_state0)
         all_sessions_state1.append(FR_per_cell_state1)
-    return np.array(all_sessions_state0,dtype=object), np.array(all_sessions_state1,dtype=object)
+    all_sessions_state0=np.array(all_sessions_state0,dtype=object)
+    all_sessions_state1=np.array(all_sessions_state1,dtype=object)
+    if return_errors:
+        return all_sessions_state0, all_sessions_state1, errors
+    return all_sessions_state0, all_sessions_state1
+
+
+def concatenate_tables(tables):
+    '''Returns the tables of run_sessions concatenated in one pd.DataFrame, with a Session column first (empty if no session succeeded)'''
+    for name in tables:
+        tables[name].insert(0, 'Session', name)
+    if not tables:
+        return pd.DataFrame(columns=['Session'])
+    return pd.concat(tables.values(), ignore_index=True)
+
+
+def compute_firing_rates(sessions, force_reload=False, n_workers=1, cache=None, return_errors=False):
+    '''
+    Returns a tidy pandas DataFrame with one row per neuron of all the sessions, to be computed once and passed to the plotting functions.
+    Columns: Session, Rat, Day, Shank, Id, Region, Type, followed by one column per state containing the mean firing rate (Hz).
+    
+    Keyword arguments:
+    sessions -- list of strings, containing the dircetories where the data files for each sessions are stored
+    force_reload -- boolean, recompute the tables of all sessions instead of reading their cache (default=False)
+    n_workers -- integer, number of processes the sessions are dispatched to, 1 runs them serially (default=1). Sessions that fail are reported and skipped (see run_sessions).
+    cache -- bk.load.SessionCache, serial runs read the local copy of each session while the next one is prefetched (default=None, bk.load.session_cache)
+    return_errors -- boolean, also return the dict {session name: traceback} of the sessions that failed (default=False)
+    '''
+    tables, errors=run_sessions(partial(session_firing_rates, force_reload=force_reload), sessions, n_workers, cache)
+    firing_rates=concatenate_tables(tables)
+    if return_errors:
+        return firing_rates, errors
+    return firing_rates
+
+
+def spike_keys(neurons):
+    '''
+    Returns the spikes of all neurons as one sorted int64 array of keys neuron*span + (time - t_min), so that the spikes of every neuron
+    in a set of windows are counted with a single searchsorted over the window edges.
+
+    Keyword arguments:
+    neurons -- numpy.ndarray of nts.Tsd, or bk.load.SpikeStore
+
+    Outputs:
+    keys, t_min (us), span (us)
+    '''
+    times, ids = bk.compute.concatenate_spikes(neurons)
+    t_min=int(times[0]) if len(times) else 0
+    span=int(times[-1])-t_min+1 if len(times) else 1
+    return np.sort(ids*span + (times-t_min)), t_min, span
+
+
+def window_counts(neurons, lefts, rights, chunk_elements=1_000_000):
+    '''
+    Returns the number of spikes of every neuron in the windows (lefts, rights] (us, same convention as nts restrict), as an int64 array neurons * windows.
+    Windows can overlap. They are processed in chunks of about chunk_elements neurons * windows (a few int64 arrays of that size each), so that memory stays bounded whatever the number of neurons.
+    '''
+    keys, t_min, span=spike_keys(neurons)
+    chunk_size=max(1, chunk_elements//max(len(neurons), 1))
+    base=np.arange(len(neurons), dtype=np.int64)[:, None]*span
+    counts=np.empty((len(neurons), len(lefts)), dtype=np.int64)
+    for first in range(0, len(lefts), chunk_size):
+        # Edges outside the spikes are clipped so that the key of a neuron never reaches the next one
+        left=np.clip(np.asarray(lefts[first:first+chunk_size], dtype=np.int64)-t_min, -1, span-1)
+        right=np.clip(np.asarray(rights[first:first+chunk_size], dtype=np.int64)-t_min, -1, span-1)
+        counts[:, first:first+chunk_size]=np.searchsorted(keys, base+right, 'right')-np.searchsorted(keys, base+left, 'right')
+    return counts
+
+
+def firing_rate_trajectories(neurons, intervals, window=60, step=None):
+    '''
+    Returns the firing rate of every neuron in sliding windows within each epoch of intervals (windows never overlap two epochs).
+
+    Keyword arguments:
+    neurons -- numpy.ndarray of nts.Tsd, or bk.load.SpikeStore
+    intervals -- nts.IntervalSet, e.g. bk.load.states()['sws']
+    window -- float, length of the windows in seconds (default=60)
+    step -- float, time in seconds between the starts of consecutive windows (default=None, same as window)
+
+    Outputs:
+    windows -- pd.DataFrame, one row per window: Epoch (index of the epoch in intervals), Start, End (s) and Phase (middle of the window as a fraction of the epoch, from 0 to 1)
+    rates -- np.ndarray, number of neurons * number of windows (Hz). Epochs shorter than window have no window.
+    '''
+    window_us=int(window*1_000_000)
+    step_us=window_us if step is None else int(step*1_000_000)
+    epochs=bk.intervals.from_nts(intervals)
+    length=epochs[:, 1]-epochs[:, 0]
+    n_windows=np.maximum((length-window_us)//step_us+1, 0)
+    epoch, k=bk.compute.expand_ranges(np.zeros(len(epochs), dtype=np.int64), n_windows)
+    lefts=epochs[epoch, 0]+k*step_us
+    rights=lefts+window_us
+
+    rates=window_counts(neurons, lefts, rights)/window
+    windows=pd.DataFrame({'Epoch': epoch, 'Start': lefts/1_000_000, 'End': rights/1_000_000,
+                          'Phase': (lefts+window_us/2-epochs[epoch, 0])/np.maximum(length[epoch], 1)})
+    return windows, rates
+
+
+def epoch_fraction_rates(neurons, intervals, n_fractions=3):
+    '''
+    Returns the firing rate of every neuron in each fraction of normalized epoch time: every epoch is cut in n_fractions parts of equal length,
+    and the spikes and durations of the k-th part of all epochs are pooled (e.g. first vs last third of sws).
+
+    Keyword arguments:
+    neurons -- numpy.ndarray of nts.Tsd, or bk.load.SpikeStore
+    intervals -- nts.IntervalSet, e.g. bk.load.states()['sws']
+    n_fractions -- integer, number of parts each epoch is cut in (default=3)
+
+    Outputs:
+    np.ndarray, number of neurons * n_fractions (Hz), NaN if intervals is empty
+    '''
+    epochs=bk.intervals.from_nts(intervals)
+    length=epochs[:, 1]-epochs[:, 0]
+    k=np.arange(n_fractions+1)
+    edges=epochs[:, :1]+length[:, None]*k//n_fractions
+    lefts, rights=edges[:, :-1], edges[:, 1:]
+
+    counts=window_counts(neurons, lefts.ravel(), rights.ravel()).reshape(len(neurons), len(epochs), n_fractions).sum(axis=1)
+    durations=(rights-lefts).sum(axis=0)/1_000_000
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(durations > 0, counts/durations, np.nan)
+
+
+def sleep_split_rates(neurons, states=None, sleep=None, state_names=('sws', 'Rem')):
+    '''
+    Returns a pandas DataFrame with the mean firing rate of each neuron during each state, separately in pre and post training sleep.
+
+    Keyword arguments:
+    neurons -- numpy.ndarray of nts.Tsd, or bk.load.SpikeStore
+    states -- dict of nts.IntervalSet, as returned by bk.load.states() (default=None, the states of the current session)
+    sleep -- tuple of 2 nts.IntervalSet, as returned by bk.load.sleep() (default=None, the sleep of the current session)
+    state_names -- states to split (default=('sws', 'Rem'))
+
+    Outputs:
+    A pd.DataFrame of shape number of neurons * (2 * number of states), columns pre_<state> and post_<state>
+    '''
+    if states is None:
+        states=bk.load.states()
+    if sleep is None:
+        sleep=bk.load.sleep()
+    split={}
+    for state in state_names:
+        intervals=bk.intervals.normalize(bk.intervals.from_nts(states[state]))
+        for name, period in zip(['pre', 'post'], sleep):
+            split[name+'_'+state]=bk.intervals.to_nts(bk.intervals.intersect(intervals, bk.intervals.normalize(bk.intervals.from_nts(period))))
+    return firing_rate_matrix(neurons, split)
+
+
+def session_time_resolved_rates(session, state_names=('sws', 'Rem'), n_fractions=3):
+    '''
+    Returns a pandas DataFrame with one row per neuron of the session: its metadata, its firing rate in each fraction of normalized epoch time
+    of every state (columns <state>_<k>/<n_fractions>, see epoch_fraction_rates) and in pre and post training sleep (see sleep_split_rates).
+
+    Keyword arguments:
+    session -- string, path to the directory where the useful files are saved.
+    state_names -- states of interest (default=('sws', 'Rem'))
+    n_fractions -- integer, number of parts each epoch is cut in (default=3)
+    '''
+    neurons, metadata=bk.load.loadSpikeData(session, as_store=True)
+    states=bk.load.states(session)
+    table=metadata.reset_index(drop=True).infer_objects()
+    for state in state_names:
+        rates=epoch_fraction_rates(neurons, states[state], n_fractions)
+        for k in range(n_fractions):
+            table[state+'_'+str(k+1)+'/'+str(n_fractions)]=rates[:, k]
+    split=sleep_split_rates(neurons, states, bk.load.sleep(session), state_names)
+    return pd.concat([table, split], axis=1)
+
+
+def compute_time_resolved_rates(sessions, state_names=('sws', 'Rem'), n_fractions=3, n_workers=1, cache=None, return_errors=False):
+    '''
+    Returns a tidy pandas DataFrame with one row per neuron of all the sessions, as session_time_resolved_rates with a Session column first.
+
+    Keyword arguments:
+    sessions -- list of strings, containing the dircetories where the data files for each sessions are stored
+    state_names -- states of interest (default=('sws', 'Rem'))
+    n_fractions -- integer, number of parts each epoch is cut in (default=3)
+    n_workers -- integer, number of processes the sessions are dispatched to, 1 runs them serially (default=1). Sessions that fail are reported and skipped (see run_sessions).
+    cache -- bk.load.SessionCache, serial runs read the local copy of each session while the next one is prefetched (default=None, bk.load.session_cache)
+    return_errors -- boolean, also return the dict {session name: traceback} of the sessions that failed (default=False)
+    '''
+    tables, errors=run_sessions(partial(session_time_resolved_rates, state_names=state_names, n_fractions=n_fractions), sessions, n_workers, cache)
+    time_resolved_rates=concatenate_tables(tables)
+    if return_errors:
+        return time_resolved_rates, errors
+    return time_resolved_rates
+
+
+def split_types(firing_rates, state, brain_region):
+    '''
+    Returns 3 numpy arrays with the firing rates of pyramidal cells, interneurons and other cells during a state.
+    
+    Keyword arguments:
+    firing_rates -- pd.DataFrame, as returned by compute_firing_rates
+    state -- string, state of interest
+    brain_region -- string, brain region of interest. Can be 'BLA' or 'Hpc'
+    '''
+    in_region=firing_rates['Region']==brain_region
+    pyramidal=firing_rates[state][(firing_rates['Type']=='Pyr') & in_region].values
+    interneurons=firing_rates[state][(firing_rates['Type']=='Int') & in_region].values
+    other_neurons=firing_rates[state][firing_rates['Type']=='Unk'].values
+    return pyramidal, interneurons, other_neurons
 
 
 def double_flatten(array):
@@ -103,22 +431,23 @@ def plot_scatter(sessions, states, brain_region):
     '''Plots a scatter plot
     
     Keyword arguments:
-    sessions -- list os strings, containting the directory paths to all the sessions of interest
+    sessions -- list os strings, containting the directory paths to all the sessions of interest, or the pd.DataFrame returned by compute_firing_rates
     states -- list of two strings, containing the states of interest
     brain_region -- string, brain regions of interest
     
     Ouput:
     Scatter plot where the state listed first appears in the x axis and the state listed second appears on the y axis
     '''
-    state0,state1=calculate_firing_rates_multiple_sessions(sessions, states, brain_region)
+    firing_rates=sessions if isinstance(sessions, pd.DataFrame) else compute_firing_rates(sessions)
+    pyr0,inter0,other0=split_types(firing_rates, states[0], brain_region)
+    pyr1,inter1,other1=split_types(firing_rates, states[1], brain_region)
     identity=np.linspace(-10,100,101) 
     plt.figure()
     plt.plot(identity,identity, 'k-', color='b')
     title='Firing rates at '+brain_region+' : '+states[0]+ ' vs '+ states[1]
-    for i in range(len(state0)):
-        plt.scatter(state0[i][2],state1[i][2], color='gray',alpha=0.5)
-        plt.scatter(state0[i][0],state1[i][0], color='r', alpha=0.5)
-        plt.scatter(state0[i][1],state1[i][1], color='b', alpha=0.5)
+    plt.scatter(other0,other1, color='gray',alpha=0.5)
+    plt.scatter(pyr0,pyr1, color='r', alpha=0.5)
+    plt.scatter(inter0,inter1, color='b', alpha=0.5)
     plt.yscale('log')
     plt.xscale('log')
     plt.xlabel(f'{states[0]} rate (Hz)')
@@ -130,24 +459,29 @@ def plot_scatter(sessions, states, brain_region):
 
 
 
-def plot_histogram(data, title, bin_size=50, upper_axis_bound=100, lower_axis_bound=0.1):
+def plot_histogram(data, title, bin_size=50, upper_axis_bound=100, lower_axis_bound=0.1, state=None, brain_region=None):
     '''
     Plots a histogram
     
     Keyword arguments:
-    data -- variable containing the data to be plotted
+    data -- variable containing the data to be plotted, either the pd.DataFrame returned by compute_firing_rates or one of the arrays returned by calculate_firing_rates_multiple_sessions
     title -- string specifying the table of the graph
     bin_size -- integer, size of bins to be used (Default=50)
     upper_axis_bound -- integer, upper boundary of the two axes, optional (Default=100)
     lower_axis_bound -- integer, lower boundary of the two axes, optional (Default=0)
+    state -- string, state to plot, only used when data is a pd.DataFrame (Default=None)
+    brain_region -- string, brain region to plot, only used when data is a pd.DataFrame (Default=None)
     
     Ouput:
     Scatter plot where the state listed first appears in the x axis and the state listed second appears on the y axis
     '''
-    other,inter,pyr=np.hsplit(data,3)
-    pyr=double_flatten(pyr)
-    inter=double_flatten(inter)
-    other=double_flatten(other)
+    if isinstance(data, pd.DataFrame):
+        pyr,inter,other=split_types(data, state, brain_region)
+    else:
+        pyr,inter,other=np.hsplit(data,3)
+        pyr=double_flatten(pyr)
+        inter=double_flatten(inter)
+        other=double_flatten(other)
     logbins = np.logspace(np.log10(lower_axis_bound),np.log10(upper_axis_bound),bin_size)
     plt.figure()
     plt.hist(other, logbins, color='gray', label='Other')
@@ -169,11 +503,9 @@ def plot_both_histograms(sessions, states, brain_region,bin_size=50, upper_axis_
     Plots two histogram,one for each brain state, showing the distribution of firing rates. 
     
     Keyword arguments:
-    sessions -- list os strings, containting the directory paths to all the sessions of interest
+    sessions -- list os strings, containting the directory paths to all the sessions of interest, or the pd.DataFrame returned by compute_firing_rates
     states -- list of two strings, containing the states of interest
     brain_region -- string, brain regions of interest
-    data -- variable containing the data to be plotted
-    title -- string, specifying the title of the graph
     bin_size -- integer, size of bins to be used (Default=50)
     upper_axis_bound -- integer, upper boundary of the two axes (Default=100)
     lower_axis_bound -- integer, lower boundary of the two axes (Default=0)
@@ -181,10 +513,8 @@ def plot_both_histograms(sessions, states, brain_region,bin_size=50, upper_axis_
     Ouput:
     Scatter plot where the state listed first appears in the x axis and the state listed second appears on the y axis
     '''
-    state0,state1=calculate_firing_rates_multiple_sessions(sessions, states, brain_region)
-    title0 = 'Firing rate distribution at ' + brain_region + ' during ' + states[0]
-    title1 = 'Firing rate distribution at ' + brain_region + ' during ' + states[1]
-    histogram_region_1=plot_histogram(state0, title0)
-    histogram_region_2=plot_histogram(state1, title1)
+    firing_rates=sessions if isinstance(sessions, pd.DataFrame) else compute_firing_rates(sessions)
+    for state in states:
+        title = 'Firing rate distribution at ' + brain_region + ' during ' + state
+        plot_histogram(firing_rates, title, bin_size, upper_axis_bound, lower_axis_bound, state, brain_region)
     return; 
-